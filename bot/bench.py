@@ -0,0 +1,306 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2019 Schmidt Cristian Hernán
+'''Benchmarks of the hot paths of the bot.'''
+# The modules measured by each benchmark are imported in it, only the one
+# run loads them. All need the requirements of the bot: captcha imports
+# debug, that imports telegram and sqlalchemy.
+# pylint: disable=import-outside-toplevel
+
+import gc
+import os
+import sys
+import time
+import random
+import argparse
+import datetime
+import threading
+import tracemalloc
+
+from captcha import get_captcha
+
+NUM_ANSWERS = 6
+
+
+def reseed():
+    # Former behavior: the global generator was reseeded for every captcha
+    seed = time.time() + int.from_bytes(os.urandom(4), byteorder='big')
+    random.seed(seed)
+
+
+def run_threads(num_threads, num_calls, func):
+    barrier = threading.Barrier(num_threads + 1)
+
+    def worker():
+        barrier.wait()
+        for _ in range(num_calls):
+            func()
+
+    threads = [threading.Thread(target=worker) for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def bench_captcha(args):
+    '''Captchas per second generated by many threads at the same time.'''
+
+    def thread_local():
+        get_captcha(NUM_ANSWERS)
+
+    def global_reseed():
+        reseed()
+        get_captcha(NUM_ANSWERS)
+
+    print(f'{"threads":>8} {"thread-local":>14} {"global reseed":>14}  captchas/s')
+    for num_threads in args.threads:
+        rates = []
+        for func in (thread_local, global_reseed):
+            elapsed = run_threads(num_threads, args.calls, func)
+            rates.append(num_threads * args.calls / elapsed)
+        print(f'{num_threads:>8} {rates[0]:>14.0f} {rates[1]:>14.0f}')
+
+
+def get_former_context():
+    # Former construction of Context: instance dict, a logger lookup, a new
+    # Sentinel for each attribute and the closures of send and edit
+    import logging
+    import functools
+    from telegram import Update
+
+    class Sentinel:
+        def __bool__(self):
+            return False
+
+        def __getattr__(self, name):
+            return Sentinel()
+
+    class FormerContext:
+        # pylint: disable=too-many-instance-attributes,too-few-public-methods
+        def __init__(self, mem, dbs, args, kwargs):
+            self.logger = logging.getLogger(__name__)
+            self.mem = mem
+            self.dbs = dbs
+            self.bot = args[0]
+            self.tgc = Sentinel()
+            self.tgu = Sentinel()
+            self.tgm = Sentinel()
+            self.chat = Sentinel()
+            self.user = Sentinel()
+            self.update = Sentinel()
+            self.job = Sentinel()
+            self.admission = Sentinel()
+            self.expulsion = Sentinel()
+            self.restriction = Sentinel()
+            self.__dict__.update(kwargs)
+
+            update = args[1]
+            if isinstance(update, Update):
+                self.update = update
+                self.tgc, self.tgu = update.effective_chat, update.effective_user
+                self.tgm = update.effective_message
+            if self.tgu:
+                self.user = self.get() or Sentinel()
+            if self.tgc:
+                self.chat = self.get() or Sentinel()
+                if self.tgu:
+                    params = {'chat_id': self.tgc.id, 'user_id': self.tgu.id}
+                    self.admission = self.get(**params) or Sentinel()
+                    self.restriction = self.get(**params) or Sentinel()
+                    self.expulsion = self.get(**params) or Sentinel()
+
+            params = {'parse_mode': 'HTML', 'disable_web_page_preview': True}
+            if self.tgc:
+                params['chat_id'] = self.tgc.id
+            self.send = self._define(self.bot.send_message, **params)
+            if self.tgm:
+                params['message_id'] = self.tgm.message_id
+            self.edit = self._define(self.bot.edit_message_text, **params)
+
+        @staticmethod
+        def get(**kwargs):
+            # pylint: disable=unused-argument
+            return None
+
+        def _define(self, func, **params):
+            @functools.wraps(func)
+            def decorator(**kwargs):
+                return func(**{**params, **kwargs})
+            return decorator
+
+    return FormerContext
+
+
+def get_collections(generation=0):
+    return gc.get_stats()[generation]['collections']
+
+
+def bench_context(args):
+    '''Time, memory, allocated blocks and generation 0 collections of the
+    construction of Context.
+
+    The queries are replaced by lookups that find nothing, to measure only
+    the construction, compared with the former one.
+    '''
+    # pylint: disable=too-many-locals
+    import telegram
+    from context import Context, Memory
+
+    class CurrentContext(Context):
+        # pylint: disable=unused-argument
+        __slots__ = ()
+
+        def get_user(self, **attributes):
+            return None
+
+        def get_admissions(self, *, chat_id=None, user_id=None):
+            return None
+
+        get_chat = get_user
+        get_restrictions = get_expulsion = get_admissions
+
+    bot = telegram.Bot('123456:BENCHMARK')
+    chat = telegram.Chat(-1001, telegram.Chat.SUPERGROUP, title='bench')
+    user = telegram.User(1001, 'bench', False)
+    message = telegram.Message(1, user, datetime.datetime.now(), chat, text='hola')
+    update = telegram.Update(1, message=message)
+    delta = datetime.timedelta(minutes=1)
+    mem = Memory(1024, delta, delta)
+
+    print(f'{"":>8} {"µs/context":>11} {"bytes/context":>14} '
+          f'{"blocks/context":>15} {"gen0/1k contexts":>17}')
+    for name, model in (('former', get_former_context()), ('current', CurrentContext)):
+        def build():
+            return model(mem, None, (bot, update), {})  # pylint: disable=cell-var-from-loop
+
+        for _ in range(100):  # warm up
+            build()
+        start = time.perf_counter()
+        for _ in range(args.calls):
+            build()
+        elapsed = time.perf_counter() - start
+
+        # Blocks, collections and memory of the contexts alive at the same
+        # time, as the ones of the queued updates
+        gc.collect()
+        blocks = sys.getallocatedblocks()
+        collections = get_collections()
+        contexts = [build() for _ in range(args.calls)]
+        collections = get_collections() - collections
+        blocks = sys.getallocatedblocks() - blocks
+        del contexts
+        gc.collect()
+        tracemalloc.start()
+        contexts = [build() for _ in range(args.calls)]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del contexts
+
+        print(f'{name:>8} {elapsed / args.calls * 1e6:>11.2f} '
+              f'{size / args.calls:>14.0f} {blocks / args.calls:>15.1f} '
+              f'{collections * 1000 / args.calls:>17.2f}')
+
+
+def bench_queries(args):
+    '''Time of the hot queries, building them each time or baked.
+
+    The compilation is timed apart, compiling the statements of the same
+    queries: for each call if built, once if baked.
+    '''
+    # pylint: disable=too-many-locals
+    from context import get_query
+    from database import DatabaseEngine, Chat, User, Admission, Restriction, Expulsion
+
+    os.environ['BENCH_DATABASE'] = 'sqlite://'
+    dbs = DatabaseEngine('BENCH_DATABASE').get_session(create_all_tables=True)
+    now = datetime.datetime.now()
+    dbs.add_all([Chat(id=-1, title='bench'), User(id=1)])
+    dbs.add_all([Admission(chat_id=-1, user_id=1, join_message_id=1,
+                           join_message_date=now),
+                 Restriction(chat_id=-1, user_id=1, until=now),
+                 Expulsion(chat_id=-1, user_id=1, reason='bench', until=now)])
+    dbs.commit()
+
+    def get_built(model, chat_id=None, user_id=None):
+        query = dbs.query(model)
+        if chat_id:
+            query = query.filter_by(chat_id=chat_id)
+        if user_id:
+            query = query.filter_by(user_id=user_id)
+        if chat_id and user_id:
+            query = query.limit(1)
+        return query
+
+    def built(model, chat_id=None, user_id=None):
+        # Former behavior: the query is built and compiled for each call
+        query = get_built(model, chat_id, user_id)
+        if chat_id and user_id:
+            return query.first()
+        return query.all()
+
+    def baked(model, chat_id=None, user_id=None):
+        return get_query(dbs, model, chat_id, user_id)
+
+    def run_queries(func, calls=args.calls):
+        # Context of an update, greeting_thread and menu_handler
+        for _ in range(calls):
+            for model in (Admission, Restriction, Expulsion):
+                func(model, -1, 1)
+            func(Admission, chat_id=-1)
+            func(Admission, user_id=1)
+            func(Expulsion, user_id=1)
+            dbs.expunge_all()
+
+    def compile_statements(model, chat_id=None, user_id=None):
+        get_built(model, chat_id, user_id).statement.compile(dialect=dialect)
+
+    dialect = dbs.get_bind().dialect
+    num = args.calls * 6
+    print(f'{"":>8} {"µs/query":>10} {"compile µs/query":>18} {"compile share":>14}')
+    for func, compilations in ((built, args.calls), (baked, 1)):
+        run_queries(func)  # warm up
+        start = time.perf_counter()
+        run_queries(func)
+        elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        run_queries(compile_statements, compilations)
+        compiling = time.perf_counter() - start
+        print(f'{func.__name__:>8} {elapsed / num * 1e6:>10.1f} '
+              f'{compiling / num * 1e6:>18.1f} {compiling / elapsed:>14.0%}')
+    dbs.close()
+
+
+BENCHMARKS = {
+    'captcha': bench_captcha,
+    'context': bench_context,
+    'queries': bench_queries,
+}
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        'benchmark',
+        help='benchmark to run',
+        choices=sorted(BENCHMARKS))
+    parser.add_argument(
+        '-c', '--calls',
+        help='calls per thread',
+        type=int,
+        default=2000)
+    parser.add_argument(
+        '-t', '--threads',
+        help='number of threads, can be repeated',
+        type=int,
+        action='append')
+    args = parser.parse_args()
+    args.threads = args.threads or [1, 4, 16, 64]
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    run()
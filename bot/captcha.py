@@ -1,11 +1,12 @@
 # -*- coding: UTF-8 -*-
 # Copyright (C) 2019 Schmidt Cristian Hernán
 
-import re
-import random
 import operator
+import itertools
+import collections
 
 from debug import flogger
+from tools import get_random
 
 OPERATORS = '+-*/'
 MAX_NUMBER = 9
@@ -25,28 +26,83 @@ SPACE = ('\u0020\u00a0\u2002\u2003\u2004\u2005\u2006'
 INVISIBLE = '\u2061\u2062\u2063\u2064'
 
 
-def get_space():
-    spaces = ''
-    # \u200b: ZERO WIDTH SPACE
-    # \ufeff: ZERO WIDTH NO-BREAK SPACE
-    while re.match('^[\u200b\ufeff]*$', spaces):
-        spaces += random.choice(SPACE)
-    return spaces
+ZERO_WIDTH = '\u200b\ufeff'  # ZERO WIDTH SPACE, ZERO WIDTH NO-BREAK SPACE
+VISIBLE_SPACE = ''.join(c for c in SPACE if c not in ZERO_WIDTH)
+MAX_ZERO_WIDTH = 2
+
+Question = collections.namedtuple('Question', 'num_a operator num_b answer extras fakes')
+
+
+def get_spaces():
+    '''All the spaces: some zero width characters and a visible one.
+
+    The weights are those of choosing characters of SPACE until getting
+    a visible one, discarding more than MAX_ZERO_WIDTH zero width characters.
+    '''
+    spaces = []
+    weights = []
+    for num in range(MAX_ZERO_WIDTH + 1):
+        for prefix in itertools.product(ZERO_WIDTH, repeat=num):
+            for char in VISIBLE_SPACE:
+                spaces.append(''.join(prefix) + char)
+                weights.append(len(SPACE) ** -(num + 1))
+    return tuple(spaces), tuple(itertools.accumulate(weights))
+
+
+def get_questions():
+    '''All the valid questions by operator, with their fake answers.'''
+    questions = {}
+    for operator_sym in OPERATORS:
+        operator_func = OPERATOR_FUNC[operator_sym]
+        questions[operator_sym] = []
+        for num_a, num_b in itertools.product(range(MAX_NUMBER + 1), repeat=2):
+            try:
+                answer = operator_func(num_a, num_b)
+            except ZeroDivisionError:
+                continue
+            abs_answer = abs(answer)
+            int_answer = int(answer)
+            if abs_answer >= MAX_NUMBER or int_answer != answer:
+                continue
+
+            # Answers that can be confused with the operands
+            extras = []
+            if num_a != answer:
+                extras.append(f'{num_a}')
+                if num_a != 0:
+                    extras.append(f'{num_a}{num_b}')
+            if num_b not in (answer, num_a):
+                extras.append(f'{num_b}')
+
+            fakes = tuple(str(num) for num in range(-MAX_NUMBER, MAX_NUMBER + 1)
+                          if abs(abs_answer - abs(num)) > MIN_SEPARATION)
+            questions[operator_sym].append(Question(num_a, operator_sym, num_b,
+                                                    str(int_answer),
+                                                    tuple(extras), fakes))
+    return {sym: tuple(lst) for sym, lst in questions.items()}
+
+
+SPACES, SPACES_CUM_WEIGHTS = get_spaces()
+QUESTIONS = get_questions()
 
 
-def get_invisible():
-    return random.choice(INVISIBLE)
+def get_space(rnd):
+    return rnd.choices(SPACES, cum_weights=SPACES_CUM_WEIGHTS)[0]
 
 
-def get_captcha_text(*items):
+def get_invisible(rnd):
+    return rnd.choice(INVISIBLE)
+
+
+def get_captcha_text(rnd, *items):
     chars = []
-    chars.append(get_invisible())
+    chars.append(get_invisible(rnd))
     for item in items:
-        chars.append(get_space())
-        chars.append(get_invisible())
+        chars.append(get_space(rnd))
+        chars.append(get_invisible(rnd))
         chars.append(str(item))
-    chars.append(get_space())
-    chars.append(get_invisible())
+    chars.append(get_space(rnd))
+    chars.append(get_invisible(rnd))
     return ''.join(chars)
 
 
@@ -58,43 +114,22 @@ def get_captcha(num_answers):
     # number can be up to 4 more than the MAX_NUMBER_ANSWERS but cannot be
     # guaranteed right now
 
-    operator_sym = random.choice(OPERATORS)
-    operator_func = OPERATOR_FUNC[operator_sym]
-    while True:
-        num_a = random.randint(0, MAX_NUMBER)
-        num_b = random.randint(0, MAX_NUMBER)
-        try:
-            answer = operator_func(num_a, num_b)
-            abs_answer = abs(answer)
-            int_answer = int(answer)
-            if abs_answer < MAX_NUMBER and int_answer == answer:
-                break
-        except ZeroDivisionError:
-            pass
+    rnd = get_random()
+    question = rnd.choice(QUESTIONS[rnd.choice(OPERATORS)])
 
     # Obfuscation
-    captcha = get_captcha_text(num_a, operator_sym, num_b)
+    captcha = get_captcha_text(rnd, question.num_a, question.operator,
+                               question.num_b)
 
     # Correct and fake answers
-    correct_answer = str(int_answer)
-    answers = []
-    if num_answers > 4:
-        if num_a != answer:
-            answers.append(f'{num_a}')
-            if num_a != 0:
-                answers.append(f'{num_a}{num_b}')
-        if num_b not in (answer, num_a):
-            answers.append(f'{num_b}')
+    correct_answer = question.answer
+    answers = list(question.extras) if num_answers > 4 else []
 
     limit = num_answers - 1
-    while len(answers) < limit:
-        num = random.randint(-MAX_NUMBER, MAX_NUMBER)
-        if abs(abs_answer - abs(num)) > MIN_SEPARATION:
-            num = str(num)
-            if num not in answers and num != correct_answer:
-                answers.append(num)
-
-    random.shuffle(answers)
+    fakes = [fake for fake in question.fakes if fake not in answers]
+    answers.extend(rnd.sample(fakes, limit - len(answers)))
+
+    rnd.shuffle(answers)
     # Never put the correct_answer in the beginning
-    answers.insert(random.randint(1, limit), correct_answer)
+    answers.insert(rnd.randint(1, limit), correct_answer)
     return captcha, correct_answer, answers
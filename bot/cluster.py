@@ -0,0 +1,153 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2019 Schmidt Cristian Hernán
+'''Webhook front that partitions the updates between worker processes.
+
+The updates of a chat (or of a user, if they have no chat) always go to
+the same worker, in the order that they were received, so each worker
+owns the timers and the memory of its partition. All the workers share
+the database.
+'''
+
+import os
+import json
+import bisect
+import signal
+import hashlib
+import logging
+import multiprocessing
+from queue import Empty
+
+from telegram import Bot, Update
+
+from webhook import Ingestion, serve, start_dispatcher, stop_dispatcher
+
+REPLICAS = 64  # virtual nodes per worker in the ring
+ORPHAN_CHECK = 5  # seconds
+
+CHAT_UPDATES = ('message', 'edited_message', 'channel_post', 'edited_channel_post')
+USER_UPDATES = ('inline_query', 'chosen_inline_result', 'shipping_query',
+                'pre_checkout_query')
+
+logger = logging.getLogger(__name__)
+
+
+def get_hash(key):
+    digest = hashlib.md5(str(key).encode()).digest()
+    return int.from_bytes(digest[:8], byteorder='big')
+
+
+class HashRing:
+
+    '''Consistent hashing of keys (chat_id or user_id) to workers.'''
+
+    __slots__ = ('hashes', 'nodes')
+
+    def __init__(self, num_nodes, replicas=REPLICAS):
+        points = sorted((get_hash(f'{node}:{replica}'), node)
+                        for node in range(num_nodes)
+                        for replica in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def __repr__(self):
+        return f'«{self.__class__.__name__}:{len(set(self.nodes))}»'
+
+    def get(self, key):
+        index = bisect.bisect(self.hashes, get_hash(key)) % len(self.hashes)
+        return self.nodes[index]
+
+
+class Partition:
+
+    '''The part of the chats and users owned by a worker.'''
+
+    __slots__ = ('index', 'ring')
+
+    def __init__(self, index, ring):
+        self.index = index
+        self.ring = ring
+
+    def __repr__(self):
+        return f'«{self.__class__.__name__}:{self.index}»'
+
+    def owns(self, key):
+        return self.ring.get(key) == self.index
+
+
+def get_partition_key(data):
+    '''chat_id of the update, or user_id for the updates without chat.'''
+    for kind in CHAT_UPDATES:
+        if kind in data:
+            return data[kind]['chat']['id']
+    if 'callback_query' in data:
+        query = data['callback_query']
+        if 'message' in query:
+            return query['message']['chat']['id']
+        return query['from']['id']
+    for kind in USER_UPDATES:
+        if kind in data:
+            return data[kind]['from']['id']
+    return 0
+
+
+def run_worker(get_updater, shutdown, partition, queue):
+    '''Process the updates of the partition with the handlers of the bot.'''
+    # The signals to the group of processes are handled by the front, that
+    # stops the workers with None once it does not accept more updates
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    front = os.getppid()
+
+    updater = get_updater(partition)
+    thread = start_dispatcher(updater, name=f'dispatcher{partition.index}')
+    logger.info('worker %d started', partition.index)
+
+    while True:
+        try:
+            data = queue.get(timeout=ORPHAN_CHECK)
+        except Empty:
+            if os.getppid() != front:
+                logger.warning('worker %d without front', partition.index)
+                break
+            continue
+        if data is None:
+            break
+        # Already validated by the front. The put waits while the lanes are
+        # full, then this queue fills up and the front answers 429
+        updater.update_queue.put(Update.de_json(json.loads(data), updater.bot))
+
+    stop_dispatcher(updater, thread)
+    if shutdown:
+        shutdown()
+    logger.info('worker %d stopped', partition.index)
+
+
+def run(get_updater, num_workers, token, host, bind, port, queue_size,
+        get_seen=None, shutdown=None):
+    '''Start the workers and the webhook front, until it is interrupted.'''
+    # pylint: disable=too-many-arguments,too-many-locals
+    ring = HashRing(num_workers)
+    queues = [multiprocessing.Queue() for _ in range(num_workers)]
+    workers = [multiprocessing.Process(target=run_worker,
+                                       args=(get_updater, shutdown,
+                                             Partition(index, ring), queues[index]),
+                                       name=f'worker{index}')
+               for index in range(num_workers)]
+    for worker in workers:
+        worker.start()
+
+    # Each worker has its own bounded queue, the updates seen are global
+    seen = get_seen() if get_seen else None
+    ingestion = Ingestion(queues, queue_size, seen=seen,
+                          route=lambda data: ring.get(get_partition_key(data)))
+    Bot(token).set_webhook(f'{host}/{token}')
+    logger.info('start in cluster mode, %d workers', num_workers)
+    try:
+        serve(ingestion, token, bind, port)
+    finally:
+        if seen:
+            seen.flush()
+        for queue in queues:
+            queue.put(None)
+        for worker in workers:
+            worker.join()
@@ -6,26 +6,72 @@ import logging
 import datetime
 import functools
 import threading
+import contextlib
 
 from telegram import Update, TelegramError
 from telegram.ext import Job
 
+from sqlalchemy import bindparam, event, inspect
+from sqlalchemy.ext import baked
 from sqlalchemy.sql import and_, or_, exists
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.exc import SQLAlchemyError
 
 from debug import flogger
-from tools import Sentinel, run_async
-from database import (DatabaseEngine, Admission, Captcha,
-                      Restriction, Expulsion, Chat, User)
+from tools import SENTINEL, LRUCache, run_async
+from database import (DatabaseEngine, CaptchaStatus, CaptchaLocation, Admission,
+                      Captcha, Restriction, Expulsion, Chat, User, Mark,
+                      execute_upsert)
 
 HTML_NO_PREVIEW = {'parse_mode': 'HTML', 'disable_web_page_preview': True}
-
-
-def get_query(query, chat_id=None, user_id=None):
+# Extra arguments of the handlers (pass_job_queue) and decorators
+CONTEXT_KWARGS = ('job_queue', 'token')
+
+logger = logging.getLogger(__name__)
+
+# (chat_id, message_id): Captcha.id
+CAPTCHAS = LRUCache(4096)
+# (chat_id, user_id): Expulsion.id of the active one or 0, invalidated on ban
+# and again after its commit (a 0 read meanwhile without the lock is stale)
+EXPULSIONS = LRUCache(16384, 600)
+EXPULSIONS_INFO = 'expulsions'  # Session.info key: the keys to invalidate
+# Compiled SQL of the hot queries
+BAKERY = baked.bakery(size=64)
+
+
+@functools.lru_cache(maxsize=None)
+def get_baked_query(model, by_chat, by_user):
+    '''Query of the model by chat and/or user, compiled once.'''
+    # The cache key of a baked query is the code of each lambda plus the
+    # given arguments, the variables of the closures are not part of it
+    query = BAKERY(lambda dbs: dbs.query(model), model, by_chat, by_user)
+    if by_chat:
+        query.add_criteria(lambda q: q.filter(model.chat_id == bindparam('chat_id')))
+    if by_user:
+        query.add_criteria(lambda q: q.filter(model.user_id == bindparam('user_id')))
+    return query
+
+
+@functools.lru_cache(maxsize=None)
+def get_active_query(by_chat):
+    '''Active expulsions of a user (in a chat), the longest first.'''
+    query = BAKERY(lambda dbs: dbs.query(Expulsion), by_chat)
+    query.add_criteria(lambda q: q.filter(Expulsion.user_id == bindparam('user_id'),
+                                          Expulsion.until > bindparam('now')))
+    if by_chat:
+        query.add_criteria(lambda q: q.filter(Expulsion.chat_id == bindparam('chat_id')))
+    query.add_criteria(lambda q: q.order_by(Expulsion.until.desc()))
+    return query
+
+
+def get_query(dbs, model, chat_id=None, user_id=None):
+    params = {}
     if chat_id:
-        query = query.filter_by(chat_id=chat_id)
-
+        params['chat_id'] = chat_id
     if user_id:
-        query = query.filter_by(user_id=user_id)
+        params['user_id'] = user_id
+    query = get_baked_query(model, bool(chat_id), bool(user_id))(dbs).params(**params)
 
     if chat_id and user_id:
         return query.first()
@@ -35,7 +81,7 @@ def get_query(query, chat_id=None, user_id=None):
 def no_null(value):
     if value:
         return value
-    return Sentinel()
+    return SENTINEL
 
 
 class Context:
@@ -43,28 +89,33 @@ class Context:
 
     '''Contains the data of a request.'''
 
-    def __init__(self, mem, dbs, args, kwargs):
-        self.logger = logging.getLogger(__name__)
+    __slots__ = ('mem', 'dbs', 'read_only', 'bot', 'tgc', 'tgu', 'tgm', 'chat',
+                 'user', 'update', 'job', 'admission', 'expulsion', 'restriction',
+                 *CONTEXT_KWARGS)
 
+    def __init__(self, mem, dbs, args, kwargs, read_only=False):
+        # pylint: disable=too-many-arguments
         self.mem = mem
         self.dbs = dbs
+        self.read_only = read_only
         self.bot = args[0]
 
-        self.tgc = Sentinel()
-        self.tgu = Sentinel()
-        self.tgm = Sentinel()
+        self.tgc = SENTINEL
+        self.tgu = SENTINEL
+        self.tgm = SENTINEL
 
-        self.chat = Sentinel()
-        self.user = Sentinel()
+        self.chat = SENTINEL
+        self.user = SENTINEL
 
-        self.update = Sentinel()
-        self.job = Sentinel()
+        self.update = SENTINEL
+        self.job = SENTINEL
 
-        self.admission = Sentinel()
-        self.expulsion = Sentinel()
-        self.restriction = Sentinel()
+        self.admission = SENTINEL
+        self.expulsion = SENTINEL
+        self.restriction = SENTINEL
 
-        self.__dict__.update(kwargs)
+        for name in CONTEXT_KWARGS:
+            setattr(self, name, kwargs.get(name, SENTINEL))
 
         if isinstance(args[1], Update):
             self.update = args[1]
@@ -75,9 +126,9 @@ class Context:
         elif isinstance(args[1], Job):
             self.job = args[1]
 
-            context = self.job.context or []
+            context = self.job.context or ()
             if not isinstance(context, (list, tuple)):
-                context = [context]
+                context = (context,)
             num = len(context)
             if num > 0:
                 self.tgc = context[0]
@@ -90,40 +141,42 @@ class Context:
         if self.tgc and self.is_group:
             self.chat = no_null(self.get_chat(id=self.tgc.id, title=self.tgc.title))
             if self.tgu:
-                params = {'chat_id': self.tgc.id, 'user_id': self.tgu.id}
-                self.admission = no_null(self.get_admissions(**params))
-                self.restriction = no_null(self.get_restrictions(**params))
-                self.expulsion = no_null(self.get_expulsions(**params))
-
-        # Definition alias to methods
-        params = HTML_NO_PREVIEW.copy()
+                chat_id = self.tgc.id
+                user_id = self.tgu.id
+                self.admission = no_null(self.get_admissions(chat_id=chat_id,
+                                                             user_id=user_id))
+                self.restriction = no_null(self.get_restrictions(chat_id=chat_id,
+                                                                 user_id=user_id))
+                self.expulsion = no_null(self.get_expulsion(chat_id=chat_id,
+                                                            user_id=user_id))
 
-        if self.tgc:
-            params['chat_id'] = self.cid
 
-        self.send = self._define(self.bot.send_message, **params)
+    def __repr__(self):
+        return f'«{self.__class__.__name__}»'
 
-        if self.tgm:
-            params['message_id'] = self.mid
 
-        self.edit = self._define(self.bot.edit_message_text, **params)
+    # Alias to methods of the bot, with the chat and message of the request
+    # by default (HTML_NO_PREVIEW is merged in the only dict of the call)
 
+    def send(self, **kwargs):
+        if self.tgc and 'chat_id' not in kwargs:
+            kwargs['chat_id'] = self.tgc.id
+        return self._call(self.bot.send_message, kwargs)
 
-    def __repr__(self):
-        return f'«{self.__class__.__name__}»'
+    def edit(self, **kwargs):
+        if self.tgc and 'chat_id' not in kwargs:
+            kwargs['chat_id'] = self.tgc.id
+        if self.tgm and 'message_id' not in kwargs:
+            kwargs['message_id'] = self.tgm.message_id
+        return self._call(self.bot.edit_message_text, kwargs)
 
-
-    #@flogger
-    def _define(self, func, **params):
-        @functools.wraps(func)
-        def decorator(**kwargs):
-            result = None
-            try:
-                result = func(**{**params, **kwargs})
-            except TelegramError as tge:
-                self.logger.warning('%s: %s', func.__name__, tge)
-            return result
-        return decorator
+    @staticmethod
+    def _call(func, kwargs):
+        try:
+            return func(**{**HTML_NO_PREVIEW, **kwargs})
+        except TelegramError as tge:
+            logger.warning('%s: %s', func.__name__, tge)
+        return None
 
 
     @property
@@ -162,17 +215,47 @@ class Context:
 
     #@flogger
     def _get_db_obj(self, model, attributes):
-        query = self.dbs.query(model).filter_by(id=attributes['id'])
-        obj = query.first()
+        obj = self.dbs.query(model).get(attributes['id'])
+        if obj and all(getattr(obj, var) == val for var, val in attributes.items()):
+            return obj
+        if self.read_only:
+            return None  # new or changed, left to a read-write handler
+        # New or changed, without races with other processes
+        return self.upsert(model, ('id',), **attributes)
+
+    def upsert(self, model, keys, **values):
+        '''Insert or update the row of the unique keys, return its object.'''
+        row = execute_upsert(self.dbs, model, keys, values)
+        if row is not None:
+            return self.get_upserted(model, row)
+
+        # Without native upsert: SELECT and then INSERT or UPDATE
+        where = {key: values[key] for key in keys}
+        obj = self.dbs.query(model).filter_by(**where).first()
         if obj:
-            for var, val in attributes.items():
-                if var != 'id':
-                    setattr(obj, var, val)
+            for var, val in values.items():
+                setattr(obj, var, val)
         else:
-            obj = model(**attributes)
+            obj = model(**values)
             self.dbs.add(obj)
         return obj
 
+    def get_upserted(self, model, row):
+        '''The object of the row returned by the upsert, without a SELECT.'''
+        mapper = inspect(model)
+        identity = mapper.identity_key_from_primary_key(
+            [row[column.name] for column in mapper.primary_key])
+        obj = self.dbs.identity_map.get(identity)
+        if obj is None:
+            # As loaded: the relationships are loaded when they are used
+            obj = model(**dict(row.items()))
+            make_transient_to_detached(obj)
+            self.dbs.add(obj)
+        else:
+            for var, val in row.items():
+                set_committed_value(obj, var, val)
+        return obj
+
     @flogger
     def get_chat(self, **attributes):
         return self._get_db_obj(Chat, attributes)
@@ -184,31 +267,114 @@ class Context:
 
     @flogger
     def get_admissions(self, *, chat_id=None, user_id=None):
-        query = self.dbs.query(Admission)
-        return get_query(query, chat_id, user_id)
+        return get_query(self.dbs, Admission, chat_id, user_id)
 
     @flogger
     def get_restrictions(self, *, chat_id=None, user_id=None):
-        query = self.dbs.query(Restriction)
-        return get_query(query, chat_id, user_id)
+        return get_query(self.dbs, Restriction, chat_id, user_id)
 
     @flogger
-    def get_expulsions(self, *, chat_id=None, user_id=None):
-        # Expulsions are stored for a period of time
-        query = self.dbs.query(Expulsion).order_by(Expulsion.until.desc())
-        query = query.group_by(Expulsion.id, Expulsion.chat_id)
-        return get_query(query, chat_id, user_id)
+    def get_captcha(self, *, chat_id, message_id, location):
+        key = (chat_id, message_id)
+        captcha_pk = CAPTCHAS.get(key)
+        if captcha_pk:
+            captcha = self.dbs.query(Captcha).get(captcha_pk)
+            if (captcha and captcha.message_id == message_id and
+                    captcha.location is location):
+                return captcha
+
+        query = self.dbs.query(Captcha).join(Admission).filter(
+            and_(
+                Captcha.message_id == message_id,
+                Captcha.location_id == location.value,
+                (Admission.user_id if location is CaptchaLocation.PRIVATE
+                 else Admission.chat_id) == chat_id,
+            )
+        )
+        captcha = query.first()
+        if captcha:
+            CAPTCHAS.put(key, captcha.id)
+        return no_null(captcha)
+
+    @flogger
+    def get_expulsion(self, *, chat_id, user_id):
+        '''The active expulsion of the user in the chat (the longest).'''
+        now = datetime.datetime.now()
+        key = (chat_id, user_id)
+        expulsion_pk = EXPULSIONS.get(key)
+        if expulsion_pk == 0:
+            return None
+        if expulsion_pk:
+            expulsion = self.dbs.query(Expulsion).get(expulsion_pk)
+            if expulsion and expulsion.until > now:
+                return expulsion
+
+        query = get_active_query(True)(self.dbs)
+        expulsion = query.params(chat_id=chat_id, user_id=user_id, now=now).first()
+        EXPULSIONS.put(key, expulsion.id if expulsion else 0)
+        return expulsion
+
+    @flogger
+    def get_active_expulsions(self, *, user_id, now):
+        query = get_active_query(False)(self.dbs)
+        return query.params(user_id=user_id, now=now).all()
+
+    def add_expulsion(self, **attributes):
+        self.dbs.add(Expulsion(**attributes))
+        key = (attributes['chat_id'], attributes['user_id'])
+        EXPULSIONS.pop(key)
+        self.dbs.info.setdefault(EXPULSIONS_INFO, set()).add(key)
+
+
+@event.listens_for(Session, 'after_commit')
+def forget_expulsions(dbs):
+    # Also after the savepoints of a batch, the keys are popped again
+    for key in dbs.info.get(EXPULSIONS_INFO, ()):
+        EXPULSIONS.pop(key)
+
+
+class Memory:
+
+    '''State of the users in RAM, bounded and with expiration.'''
+
+    __slots__ = ('logger', 'menus', 'waits')
+
+    def __init__(self, size, menu_ttl, wait_ttl):
+        self.logger = logging.getLogger(__name__)
+        # user_id: {'num• title': chat_id}, options of the /start menu
+        self.menus = LRUCache(size, menu_ttl.total_seconds())
+        # (user_id, chat_id): Job, captcha timers to cancel ahead of time
+        self.waits = LRUCache(size, wait_ttl.total_seconds())
+
+    def __repr__(self):
+        return f'«{self.__class__.__name__}:{len(self.menus)}:{len(self.waits)}»'
+
+    @property
+    def sizes(self):
+        return {'menus': len(self.menus), 'waits': len(self.waits)}
+
+    def to_dict(self):
+        return {'menus': self.menus.to_dict(), 'waits': self.waits.to_dict()}
+
+    def purge(self, bot=None, job=None):
+        # pylint: disable=unused-argument
+        menus = self.menus.purge()
+        waits = self.waits.purge()
+        self.logger.debug('memory purged: menus=%d waits=%d, size: %s',
+                          menus, waits, self.sizes)
 
 
 class Contextualizer:
 
-    __slots__ = ('logger', 'lock', 'mem', 'dbe')
+    __slots__ = ('logger', 'lock', 'local', 'mem', 'dbe', 'replica')
 
-    def __init__(self, env_database):
+    def __init__(self, env_database, memory, env_replica=None):
         self.logger = logging.getLogger(__name__)
         self.lock = threading.Lock()
-        self.mem = {}
+        self.local = threading.local()  # session of the batch of the thread
+        self.mem = memory
         self.dbe = DatabaseEngine(env_database)
+        self.replica = DatabaseEngine(env_replica) if env_replica else None
 
 
     def __repr__(self):
@@ -218,6 +384,10 @@ class Contextualizer:
     def __call__(self, func):
         @functools.wraps(func)
         def decorator(*args, **kwargs):
+            batch = getattr(self.local, 'dbs', None)
+            if batch:
+                return self.call_nested(batch, func, args, kwargs)
+
             result = None
             dbs = None
             try:
@@ -247,11 +417,102 @@ class Contextualizer:
         return decorator
 
 
-    def initialize(self, bot, delta_delete_admissions):
+    def read_only(self, func=None, *, replica=True):
+        '''Decorator of the handlers that only read (or use write-behind).
+
+        They run without the lock and without commit, in a session of the
+        replica (with `replica` and if there is one) or of the main database.
+        The users and chats new or changed are left as SENTINEL. In a batch
+        the session of the batch is used, to see its changes.
+        '''
+        if func is None:
+            return functools.partial(self.read_only, replica=replica)
+        dbe = self.replica if replica and self.replica else self.dbe
+
+        @functools.wraps(func)
+        def decorator(*args, **kwargs):
+            batch = getattr(self.local, 'dbs', None)
+            if batch:
+                return self.call_nested(batch, func, args, kwargs)
+
+            dbs = dbe.get_session()
+            dbs.autoflush = False  # a change by mistake never reaches the db
+            try:
+                ctx = Context(self.mem, dbs, args, kwargs, read_only=True)
+                self.logger.debug('go to %s (read-only)', func.__name__)
+                return func(ctx)
+            finally:
+                dbs.close()  # rollback of the transaction
+        return decorator
+
+
+    def call_nested(self, dbs, func, args, kwargs):
+        # An error only undoes the changes of its update
+        savepoint = dbs.begin_nested()
+        try:
+            ctx = Context(self.mem, dbs, args, kwargs)
+            self.logger.debug('go to %s (batch)', func.__name__)
+            result = func(ctx)
+        except:
+            self.logger.exception('db rollback to savepoint')
+            savepoint.rollback()
+            raise
+        savepoint.commit()
+        return result
+
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''The handlers called inside (in this thread) share one session.'''
+        start = time.time()
+        with self.lock:
+            self.logger.debug('batch wait %.3f seconds', time.time() - start)
+            dbs = self.dbe.get_session()
+            self.local.dbs = dbs
+            try:
+                yield dbs
+            except:
+                self.logger.exception('db rollback (batch)')
+                dbs.rollback()
+                raise
+            else:
+                self.logger.debug('db commit (batch)')
+                dbs.commit()
+            finally:
+                self.local.dbs = None
+                dbs.close()
+
+
+    def create_tables(self):
+        '''Create the missing tables and indexes, without keeping connections.'''
+        self.dbe.get_session(create_all_tables=True).close()
+        self.dbe.close()
+
+
+    def initialize(self, bot, delta_delete_admissions, live_captchas,
+                   clean=True, owns=None, create=True):
+        # pylint: disable=too-many-arguments
+        # With several processes the tables are created before starting
+        # them, only one cleans and each one loads the captchas of the chats
+        # that it owns
+        dbs = self.dbe.get_session(create_all_tables=create)
+        if clean:
+            self.clean(dbs, bot, delta_delete_admissions)
+
+        # Captchas that still accept answers
+        waiting = CaptchaStatus.WAITING.value
+        query = dbs.query(Captcha).filter(Captcha.status_id == waiting)
+        for captcha in query.all():
+            if owns is None or owns(captcha.chat_id):
+                live_captchas.put((captcha.chat_id, captcha.message_id),
+                                  captcha.admission.user_id)
+        dbs.close()
+
+
+    def clean(self, dbs, bot, delta_delete_admissions):
         now = datetime.datetime.now()
         adm_lim = now - delta_delete_admissions
         exp_lim = now - 90 * delta_delete_admissions
-        dbs = self.dbe.get_session(create_all_tables=True)
 
         # sql = (
         #     'DELETE FROM admission WHERE join_message_date < ":adm_lim";',
@@ -321,7 +582,28 @@ class Contextualizer:
         for query in queries:
             query.delete(synchronize_session=False)
             dbs.commit()
-        dbs.close()
+
+
+    def load_mark(self, name):
+        '''Value of the mark (0 if missing), without the lock of the handlers.'''
+        dbs = self.dbe.get_session()
+        try:
+            mark = dbs.query(Mark).get(name)
+            return mark.value if mark else 0
+        except SQLAlchemyError as error:
+            self.logger.warning('mark %s not loaded: %s', name, error)
+            return 0
+        finally:
+            dbs.close()
+
+
+    def save_mark(self, name, value):
+        dbs = self.dbe.get_session()
+        try:
+            dbs.merge(Mark(name=name, value=value))
+            dbs.commit()
+        finally:
+            dbs.close()
 
 
     @run_async
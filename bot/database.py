@@ -5,16 +5,20 @@
 import os
 import hmac
 import enum
+import json
+import functools
 
-from sqlalchemy import create_engine, Column, ForeignKey, UniqueConstraint
+from sqlalchemy import create_engine, Column, ForeignKey, UniqueConstraint, Index
+from sqlalchemy import text, bindparam, inspect, and_
 from sqlalchemy import BigInteger, Integer, String, Boolean, DateTime
 from sqlalchemy.orm import sessionmaker, relationship
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm.collections import attribute_mapped_collection
 
-from tools import Sentinel, DT_FMT
+from tools import SENTINEL, DT_FMT
 
 LINK = '<a href="tg://user?id={}">{}</a>'
+MAX_GREET_USERS = 40  # names in prev_greet_users, fits in String(4096)
 BASE = declarative_base()
 
 
@@ -50,14 +54,80 @@ class DatabaseEngine:
                 BASE.metadata.drop_all(self.engine)
             if create_all_tables:
                 BASE.metadata.create_all(self.engine)
+                self.create_indexes()
             self.session.configure(bind=self.engine)
         return self.session()
 
+    def create_indexes(self):
+        # create_all only creates the indexes of the new tables
+        inspector = inspect(self.engine)
+        for table in BASE.metadata.sorted_tables:
+            names = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in names:
+                    index.create(self.engine)
+
     def close(self):
         if self.engine:
             self.engine.dispose()
 
 
+@functools.lru_cache(maxsize=64)
+def get_upsert(dialect, table, keys, columns, updates):
+    '''INSERT ... ON CONFLICT, the same syntax in Postgres and SQLite (3.24+).
+
+    The row is returned in Postgres and SQLite 3.35+.
+    '''
+    quote = dialect.identifier_preparer.quote
+    returning = (dialect.name == 'postgresql'
+                 or (dialect.server_version_info or (0,)) >= (3, 35))
+    if returning and not updates:
+        updates = keys[:1]  # DO NOTHING returns no row, the key is set to itself
+    sets = ', '.join(f'{quote(name)} = excluded.{quote(name)}' for name in updates)
+    sql = (f'INSERT INTO {quote(table.name)} '
+           f'({", ".join(map(quote, columns))}) '
+           f'VALUES ({", ".join(":" + name for name in columns)}) '
+           f'ON CONFLICT ({", ".join(map(quote, keys))}) '
+           f'{"DO UPDATE SET " + sets if sets else "DO NOTHING"}')
+    if returning:
+        sql += f' RETURNING {", ".join(quote(column.name) for column in table.c)}'
+    upsert = text(sql).bindparams(*(bindparam(name, type_=table.c[name].type)
+                                    for name in columns))
+    return upsert.columns(*table.c) if returning else upsert
+
+
+@functools.lru_cache(maxsize=None)
+def get_defaults(table):
+    # The defaults of the model are applied by sqlalchemy, not by the database
+    return {column.name: column.default.arg for column in table.columns
+            if column.default is not None and column.default.is_scalar}
+
+
+def execute_upsert(dbs, model, keys, values):
+    '''Insert or update the row of the unique keys in one statement.
+
+    Only the given values are updated. Return the row, selected again if
+    the database has no RETURNING, or None if it has no native upsert.
+    '''
+    dialect = dbs.get_bind().dialect
+    if dialect.name == 'sqlite':
+        if (dialect.server_version_info or (0,)) < (3, 24):
+            return None
+    elif dialect.name != 'postgresql':
+        return None
+    dbs.flush()  # the pending changes go first (rows referenced, deletions)
+    table = model.__table__
+    updates = tuple(sorted(name for name in values if name not in keys))
+    where = and_(*(table.c[key] == values[key] for key in keys))
+    values = {**get_defaults(table), **values}
+    upsert = get_upsert(dialect, table, tuple(keys), tuple(sorted(values)),
+                        updates)
+    result = dbs.execute(upsert, values)
+    if result.returns_rows:
+        return result.first()
+    return dbs.execute(table.select().where(where)).first()
+
+
 class Admission(BASE):
     __tablename__ = 'admission'
 
@@ -92,7 +162,7 @@ class Admission(BASE):
 
     @property
     def group_captcha(self):
-        return self.captchas.get(CaptchaLocation.GROUP, Sentinel())
+        return self.captchas.get(CaptchaLocation.GROUP, SENTINEL)
 
     #@group_captcha.setter
     #def group_captcha(self, captcha):
@@ -103,7 +173,7 @@ class Admission(BASE):
 
     @property
     def private_captcha(self):
-        return self.captchas.get(CaptchaLocation.PRIVATE, Sentinel())
+        return self.captchas.get(CaptchaLocation.PRIVATE, SENTINEL)
 
     #@private_captcha.setter
     #def private_captcha(self, captcha):
@@ -120,14 +190,24 @@ class Captcha(BASE):
     message_id = Column(BigInteger, nullable=False)
     location_id = Column(Integer, nullable=False)
     status_id = Column(Integer, nullable=False)
-    token = Column(String(48), nullable=False)
+    token = Column(String(48), nullable=False)  # captcha_id of the signed tokens
     admission_id = Column(Integer, ForeignKey('admission.id', ondelete="CASCADE"))
     admission = relationship('Admission', back_populates='captchas')
 
+    # The chat is the one of the admission (the user_id for private captchas)
+    message_index = Index('ix_captcha_message', message_id, location_id)
+
     def __repr__(self):
         return (f'Captcha:{self.id}:{self.location}:{self.status}:'
                 f'{self.message_id}:{self.admission_id}')
 
+    @property
+    def chat_id(self):
+        # The private chat_id is the user_id
+        if self.location is CaptchaLocation.PRIVATE:
+            return self.admission.user_id
+        return self.admission.chat_id
+
     @property
     def location(self):
         return CaptchaLocation(self.location_id)
@@ -152,8 +232,8 @@ class Captcha(BASE):
     #def in_private(self):
     #    return self.location is CaptchaLocation.PRIVATE
 
-    def is_correct(self, token):
-        return hmac.compare_digest(token, self.token)
+    def is_current(self, captcha_id):
+        return hmac.compare_digest(captcha_id, self.token)
 
 
 class Restriction(BASE):
@@ -190,6 +270,9 @@ class Expulsion(BASE):
     reason = Column(String, nullable=False)
     until = Column(DateTime, nullable=False)
 
+    # Active expulsions (until > now) of a user, in a chat or in all
+    active_index = Index('ix_expulsion_active', user_id, chat_id, until)
+
     def __repr__(self):
         return (f'Expulsion:{self.id}:CID{self.chat_id}:UID{self.user_id}:'
                 f'{self.until:{DT_FMT}}:{self.reason}')
@@ -210,6 +293,23 @@ class Chat(BASE):
         return (f'Chat:{self.id}:{self.title}:'
                 f'{self.prev_greet_message_id}:{self.prev_greet_users}')
 
+    @property
+    def greet_users(self):
+        if not self.prev_greet_users:
+            return []
+        try:
+            users = json.loads(self.prev_greet_users)
+        except ValueError:
+            users = None
+        if isinstance(users, list):
+            return users
+        return [self.prev_greet_users]  # previous format, a plain text
+
+    @greet_users.setter
+    def greet_users(self, users):
+        users = users[-MAX_GREET_USERS:]
+        self.prev_greet_users = json.dumps(users, ensure_ascii=False) if users else None
+
 
 class User(BASE):
     __tablename__ = 'user'
@@ -222,3 +322,13 @@ class User(BASE):
 
     def __repr__(self):
         return f'User:{self.id}:{self.strikes}'
+
+
+class Mark(BASE):
+    __tablename__ = 'mark'
+
+    name = Column(String(32), primary_key=True)
+    value = Column(BigInteger, nullable=False)
+
+    def __repr__(self):
+        return f'Mark:{self.name}:{self.value}'
@@ -17,6 +17,7 @@ import logging
 import datetime
 import functools
 import threading
+import collections
 
 import telegram
 import telegram.ext
@@ -24,7 +25,7 @@ import telegram.ext
 import sqlalchemy
 import sqlalchemy.orm
 
-from tools import DT_FMT
+from tools import DT_FMT, run_async
 from database import Admission, Captcha, Restriction, User, Chat
 
 OBJECTS = (telegram.bot.Bot, telegram.update.Update, telegram.message.Message,
@@ -137,3 +138,61 @@ def flogger(func):
                      func.__name__, __format(result), COLOR_RS)
         return result
     return decorator
+
+
+class Digest:
+
+    '''Debugging events grouped by kind and sent as a single message.
+
+    Repeated texts are counted instead of sent again, the summary is sent
+    every `interval` (with `flush` as a repeating job) or when `limit`
+    events are buffered.
+    '''
+
+    __slots__ = ('logger', 'lock', 'chat_id', 'limit', 'bot', 'events', 'num')
+
+    MAX_LENGTH = 4096  # of a Telegram message
+
+    def __init__(self, chat_id, limit):
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.chat_id = chat_id
+        self.limit = limit
+        self.bot = None
+        self.events = collections.OrderedDict()  # kind: {text: count}
+        self.num = 0
+
+    def __repr__(self):
+        return f'«{self.__class__.__name__}:{self.num}»'
+
+    def add(self, bot, kind, text):
+        with self.lock:
+            self.bot = bot
+            texts = self.events.setdefault(kind, collections.OrderedDict())
+            texts[text] = texts.get(text, 0) + 1
+            self.num += 1
+            full = self.num >= self.limit
+        if full:
+            run_async(self.flush)(bot)
+
+    def flush(self, bot=None, job=None):
+        # pylint: disable=unused-argument
+        with self.lock:
+            events, self.events = self.events, collections.OrderedDict()
+            num, self.num = self.num, 0
+            bot = bot or self.bot
+        if not events or not bot:
+            return
+
+        lines = [f'DIGEST: {num} events']
+        for kind, texts in events.items():
+            lines.append(f'\n{kind} ({sum(texts.values())}):')
+            lines.extend(f'• [{count}] {text}' for text, count in texts.items())
+        text = '\n'.join(lines)
+        if len(text) > self.MAX_LENGTH:
+            text = text[:self.MAX_LENGTH - 1] + '…'
+
+        try:
+            bot.send_message(chat_id=self.chat_id, text=text)
+        except telegram.TelegramError as tge:
+            self.logger.warning('digest not sent: %s', tge)
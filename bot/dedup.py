@@ -0,0 +1,163 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2019 Schmidt Cristian Hernán
+'''Detection of the updates redelivered by Telegram, by update_id.'''
+
+import time
+import logging
+import threading
+
+from tools import run_async
+
+MASK = (1 << 64) - 1
+SAVE_INTERVAL = 10  # seconds
+
+logger = logging.getLogger(__name__)
+
+
+def get_hashes(key, num_bits, num_hashes):
+    # update_ids are sequential, they are mixed before double hashing
+    mixed = (key * 0x9E3779B97F4A7C15) & MASK
+    mixed ^= mixed >> 29
+    first = mixed & 0xffffffff
+    second = (mixed >> 32) | 1
+    return [(first + i * second) % num_bits for i in range(num_hashes)]
+
+
+class BloomFilter:
+
+    '''Compact probabilistic set of integers, without false negatives.'''
+
+    __slots__ = ('bits', 'num_bits', 'num_hashes', 'count')
+
+    def __init__(self, num_bits, num_hashes):
+        self.bits = bytearray((num_bits + 7) // 8)
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.count = 0
+
+    def __repr__(self):
+        return f'«{self.__class__.__name__}:{self.count}»'
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[bit >> 3] & (1 << (bit & 7))
+                   for bit in get_hashes(key, self.num_bits, self.num_hashes))
+
+    def add(self, key):
+        bits = self.bits
+        for bit in get_hashes(key, self.num_bits, self.num_hashes):
+            bits[bit >> 3] |= 1 << (bit & 7)
+        self.count += 1
+
+
+class SeenUpdates:
+    # pylint: disable=too-many-instance-attributes
+
+    '''The update_ids already accepted.
+
+    The last `size` ids are exact in a ring indexed by `id % size`. The ids
+    evicted from the ring go to a bloom filter, in two generations of
+    `capacity` ids, so an old id can be wrongly taken as seen with a
+    probability of ~0.1%. The ids up to the persisted mark (`load`/`save`)
+    are seen, the mark does not pass the ids rejected and not yet redelivered.
+    '''
+
+    __slots__ = ('lock', 'size', 'ring', 'capacity', 'blooms', 'floor', 'top',
+                 'rejected', 'duplicates', 'load', 'save', 'saved', 'saved_at')
+
+    def __init__(self, size, capacity=None, load=None, save=None):
+        self.lock = threading.Lock()
+        self.size = size
+        self.ring = [-1] * size
+        self.capacity = capacity or 16 * size
+        self.blooms = [self.get_bloom(), self.get_bloom()]
+        self.rejected = set()
+        self.duplicates = 0
+        self.load = load
+        self.save = save
+        self.floor = load() if load else 0
+        self.top = self.saved = self.floor
+        self.saved_at = time.monotonic()
+
+    def __repr__(self):
+        return f'«{self.__class__.__name__}:{self.floor}:{self.top}»'
+
+    def get_bloom(self):
+        # 14.4 bits per id and 10 hashes for false positives of 0.1%
+        return BloomFilter(self.capacity * 144 // 10, 10)
+
+    @property
+    def mark(self):
+        '''Highest id such that all the previous ones were accepted.'''
+        if self.rejected:
+            return min(self.top, min(self.rejected) - 1)
+        return self.top
+
+    def to_dict(self):
+        return {'floor': self.floor, 'top': self.top, 'mark': self.mark,
+                'duplicates': self.duplicates, 'rejected': len(self.rejected)}
+
+    def add(self, update_id):
+        '''Return False if the update was already seen.'''
+        with self.lock:
+            if update_id < self.top - self.size - 2 * self.capacity:
+                # After a week without updates the ids restart randomly
+                logger.warning('update_id=%d restart, mark=%d', update_id, self.top)
+                self.reset(update_id - 1)
+            elif self.is_seen(update_id):
+                self.duplicates += 1
+                return False
+
+            slot = update_id % self.size
+            evicted = self.ring[slot]
+            if evicted >= 0:
+                if self.blooms[0].count >= self.capacity:
+                    self.blooms = [self.get_bloom(), self.blooms[0]]
+                self.blooms[0].add(evicted)
+            self.ring[slot] = update_id
+            self.top = max(self.top, update_id)
+            self.rejected.discard(update_id)
+
+        if self.save and time.monotonic() - self.saved_at > SAVE_INTERVAL:
+            self.saved_at = time.monotonic()
+            run_async(self.flush)()
+        return True
+
+    def reset(self, floor):
+        self.ring = [-1] * self.size
+        self.blooms = [self.get_bloom(), self.get_bloom()]
+        self.rejected = set()
+        self.floor = self.top = floor
+
+    def is_seen(self, update_id):
+        if update_id <= self.floor:
+            return True
+        if update_id > self.top:
+            return False
+        if self.ring[update_id % self.size] == update_id:
+            return True
+        if update_id > self.top - self.size:
+            return False
+        return any(update_id in bloom for bloom in self.blooms)
+
+    def discard(self, update_id):
+        '''The update was not accepted, it will be delivered again.'''
+        with self.lock:
+            slot = update_id % self.size
+            if self.ring[slot] == update_id:
+                self.ring[slot] = -1
+            self.rejected.add(update_id)
+
+    def flush(self):
+        with self.lock:
+            # The rejected not redelivered since long ago are forgotten
+            horizon = self.top - self.size - 2 * self.capacity
+            self.rejected = {i for i in self.rejected if i > horizon}
+            mark = self.mark
+        if self.save and mark != self.saved:
+            try:
+                self.save(mark)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('mark of updates not saved')
+            else:
+                self.saved = mark
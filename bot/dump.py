@@ -0,0 +1,71 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2019 Schmidt Cristian Hernán
+'''Dump of the tables for debugging, streamed in chunks to a file.'''
+
+import os
+import glob
+import logging
+
+from sqlalchemy import func, text
+from sqlalchemy.exc import SQLAlchemyError
+
+CHUNK = 500  # rows fetched at a time
+PATTERN = 'debug-*.txt'  # names of the dumps, sorted by date
+
+SIZE_SQL = {
+    'postgresql': 'SELECT pg_total_relation_size(:name)',
+    # Only if sqlite was compiled with the dbstat table
+    'sqlite': ('SELECT SUM(pgsize) FROM dbstat WHERE name IN '
+               '(SELECT name FROM sqlite_master WHERE tbl_name = :name)'),
+}
+
+logger = logging.getLogger(__name__)
+
+
+def get_count(dbs, model):
+    return dbs.query(func.count()).select_from(model).scalar()
+
+
+def get_size(dbs, model):
+    '''Bytes of the table and its indexes, None if unknown.'''
+    sql = SIZE_SQL.get(dbs.get_bind().dialect.name)
+    if not sql:
+        return None
+    try:
+        return dbs.execute(text(sql), {'name': model.__tablename__}).scalar()
+    except SQLAlchemyError as error:
+        logger.debug('size of %s: %s', model.__tablename__, error)
+        dbs.rollback()
+        return None
+
+
+def write_rows(dbs, model, file, chunk=CHUNK):
+    '''Write a line by row, with a server-side cursor if the driver has one.'''
+    # Without eager loads, that are not compatible with yield_per
+    query = dbs.query(model).enable_eagerloads(False).yield_per(chunk)
+    rows = 0
+    for row in query:
+        file.write(f'• {row}\n')
+        rows += 1
+    return rows
+
+
+def open_private(path):
+    '''A new file (never an existing one) that only the owner can read.'''
+    descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        return os.fdopen(descriptor, 'w', encoding='utf-8')
+    except:
+        os.close(descriptor)
+        raise
+
+
+def prune(directory, keep):
+    '''Remove the oldest dumps of the directory, except `keep` (1 or more).'''
+    old = sorted(glob.glob(os.path.join(directory, PATTERN)))[:-keep]
+    for path in old:
+        try:
+            os.remove(path)
+        except OSError as error:
+            logger.warning('dump not removed: %s', error)
+    return len(old)
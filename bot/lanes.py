@@ -0,0 +1,176 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2019 Schmidt Cristian Hernán
+'''Queue of updates with priority lanes, for the dispatcher.'''
+
+import time
+import queue
+import logging
+import collections
+
+logger = logging.getLogger(__name__)
+
+
+class LaneStats:
+
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def __repr__(self):
+        return f'«{self.__class__.__name__}:{self.count}»'
+
+    def add(self, wait):
+        self.count += 1
+        self.total += wait
+        self.max = max(self.max, wait)
+
+    def to_dict(self):
+        mean = self.total / self.count if self.count else 0.0
+        return {'count': self.count, 'mean_ms': round(mean * 1000, 1),
+                'max_ms': round(self.max * 1000, 1)}
+
+
+class LaneQueue(queue.Queue):
+    # pylint: disable=attribute-defined-outside-init
+
+    '''The update is taken from the first lane that is not empty.
+
+    `classify(item)` returns the lane (an IntEnum, lower is first) and it
+    runs in the producer before taking the lock of the queue. The order is
+    kept inside each lane. With `key(item)` (the chat) the items of a key
+    already queued keep the lane of the first one, so their order is kept
+    too. The time waited in the queue is measured by lane.
+    '''
+
+    def __init__(self, classify, lanes, maxsize=0, key=None):
+        self.classify = classify
+        self.key = key
+        self.lane_names = [lane.name for lane in sorted(lanes)]
+        super().__init__(maxsize)
+
+    def __repr__(self):
+        return f'«{self.__class__.__name__}:{self.qsize()}»'
+
+    # Called by queue.Queue with its mutex
+    def _init(self, maxsize):
+        self.lanes = [collections.deque() for _ in self.lane_names]
+        self.stats = [LaneStats() for _ in self.lane_names]
+        self.keys = {}  # key: [lane, items queued]
+
+    def _qsize(self):
+        return sum(map(len, self.lanes))
+
+    def _put(self, item):
+        lane, key, queued, update = item
+        if key is not None:
+            entry = self.keys.get(key)
+            if entry:
+                lane = entry[0]
+                entry[1] += 1
+            else:
+                self.keys[key] = [lane, 1]
+        self.lanes[lane].append((queued, key, update))
+
+    def _get(self):
+        for lane, items in enumerate(self.lanes):
+            if items:
+                queued, key, update = items.popleft()
+                self._taken(lane, queued, key)
+                return update
+        raise queue.Empty  # not reached, get() waits for items
+
+    def _taken(self, lane, queued, key):
+        # Called with the mutex
+        self.stats[lane].add(time.monotonic() - queued)
+        if key is not None:
+            entry = self.keys[key]
+            entry[1] -= 1
+            if not entry[1]:
+                del self.keys[key]
+
+    def put(self, item, block=True, timeout=None):
+        try:
+            lane = int(self.classify(item))
+            key = self.key(item) if self.key else None
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('update not classified')
+            lane = len(self.lanes) - 1
+            key = None
+        super().put((lane, key, time.monotonic(), item), block, timeout)
+
+    def wait(self, timeout):
+        '''Wait until there is some item, up to timeout seconds.'''
+        with self.not_empty:
+            if not self._qsize():
+                self.not_empty.wait(timeout)
+
+    def take(self, match, limit):
+        '''Remove up to limit queued updates that match, in order of arrival.'''
+        taken = []
+        with self.mutex:
+            for lane, items in enumerate(self.lanes):
+                kept = collections.deque()
+                for queued, key, update in items:
+                    if len(taken) < limit and match(update):
+                        taken.append((queued, update))
+                        self._taken(lane, queued, key)
+                    else:
+                        kept.append((queued, key, update))
+                if len(kept) != len(items):
+                    self.lanes[lane] = kept
+            if taken:
+                self.not_full.notify(len(taken))
+        taken.sort(key=lambda item: item[0])
+        return [update for _, update in taken]
+
+    def to_dict(self, reset=False):
+        '''Pending updates and time waited by lane, since the last reset.'''
+        with self.mutex:
+            result = {name: dict(stats.to_dict(), pending=len(items))
+                      for name, stats, items in
+                      zip(self.lane_names, self.stats, self.lanes)}
+            if reset:
+                self.stats = [LaneStats() for _ in self.lane_names]
+        return result
+
+    def log(self, bot=None, job=None):
+        # pylint: disable=unused-argument
+        logger.info('update lanes: %s', self.to_dict(reset=True))
+
+
+def get_chat_id(update):
+    '''Key of the lanes, the updates of a chat are processed in order.'''
+    chat = getattr(update, 'effective_chat', None)
+    return chat.id if chat else None
+
+
+def get_batcher(process_update, lanes, batch, window, limit):
+    '''process_update of the dispatcher, in batches of updates of a group.
+
+    After the first update, the ones of the same group already queued are
+    taken from the lanes and processed in one `batch`. Only while the lanes
+    are empty it waits for more, up to the window (seconds).
+    '''
+    def process(update):
+        chat = getattr(update, 'effective_chat', None)
+        if not chat or chat.type == chat.PRIVATE:
+            process_update(update)
+            return
+
+        lanes.wait(window)
+        updates = [update]
+        updates.extend(lanes.take(lambda item: get_chat_id(item) == chat.id,
+                                  limit - 1))
+        try:
+            with batch():
+                for item in updates:
+                    process_update(item)
+        except Exception:  # pylint: disable=broad-except
+            # The dispatcher must keep running
+            logger.exception('batch of %d updates of chat=%d', len(updates), chat.id)
+        else:
+            logger.debug('batch of %d updates of chat=%d', len(updates), chat.id)
+    return process
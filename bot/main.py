@@ -1,6 +1,7 @@
 # -*- coding: UTF-8 -*-
 # Copyright (C) 2019 Schmidt Cristian Hernán
 '''Telegram bot for welcome.'''
+# pylint: disable=too-many-lines
 
 import sys
 assert sys.hexversion > 0x03070000, 'requires python 3.7 or higher'
@@ -9,38 +10,59 @@ assert sys.hexversion > 0x03070000, 'requires python 3.7 or higher'
 import os
 import re
 import enum
-import hmac
 import html
 import logging
 import argparse
+import tempfile
+import threading
 import datetime
 import functools
 
 from telegram import (InlineKeyboardButton, InlineKeyboardMarkup,
-                      ReplyKeyboardMarkup, ReplyKeyboardRemove)
+                      ReplyKeyboardMarkup, ReplyKeyboardRemove, ChatMember, Update)
 from telegram.ext import (Updater, Filters, ConversationHandler,
                           CallbackQueryHandler, RegexHandler,
                           CommandHandler, MessageHandler)
 from telegram.error import TelegramError
 
-from spam import is_spam
-from debug import flogger
+from spam import is_spam_update, SPAMS
+from debug import flogger, Digest
 from tools import (get_user_name, get_user_mention, run_async, get_token,
-                   change_seed, remove_diacritics, time_to_text, chunked,
-                   SECRET_PHRASE, DT_FMT)
-from context import Contextualizer
+                   get_captcha_id, check_token, LRUCache, NEW_INDEX,
+                   normalize, time_to_text, chunked,
+                   SECRET_PHRASE, DT_FMT, INVISIBLE, SPACE)
+from urls import UrlDetector, TLD_FILE, ABUSED_TLD_FILE
+from rules import BanRules
+from context import Contextualizer, Memory
+from dedup import SeenUpdates
+from lanes import LaneQueue, get_batcher, get_chat_id
+from writes import WriteBehind
+import cluster
+import webhook
+import dump
 from captcha import get_captcha
 from database import (CaptchaStatus, CaptchaLocation, BASE, User, Chat,
-                      Admission, Captcha, Restriction, Expulsion)
+                      Admission, Captcha, Restriction, Expulsion, MAX_GREET_USERS)
 
 
 DATETIME_IN_LOG = int(os.environ.get('DATETIME_IN_LOG', 1))
 DEBUG_CHAT_ID = int(os.environ['DEBUG_CHAT_ID'])
 ENV_DATABASE = os.environ['ENV_DATABASE']  # for heroku 'DATABASE_URL'
+ENV_DATABASE_REPLICA = os.environ.get('ENV_DATABASE_REPLICA')  # for reads
 TOKEN = os.environ['TELEGRAM_TOKEN']
 PORT = int(os.environ.get('PORT', 443))
 HOST = os.environ['HOST']
 BIND = os.environ['BIND']
+BAN_RULES_FILE = os.environ.get('BAN_RULES_FILE')  # JSON: [[pattern, reason], ...]
+TLD_FILE = os.environ.get('TLD_FILE', TLD_FILE)  # Public Suffix List format
+ABUSED_TLD_FILE = os.environ.get('ABUSED_TLD_FILE', ABUSED_TLD_FILE)  # a TLD by line
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 500))  # per process
+SEEN_UPDATES_SIZE = int(os.environ.get('SEEN_UPDATES_SIZE', 4096))  # exact
+BATCH_WINDOW_MS = int(os.environ.get('BATCH_WINDOW_MS', 0))  # 0: no batches
+BATCH_SIZE = int(os.environ.get('BATCH_SIZE', 20))  # updates of a group
+WRITE_BEHIND_MS = int(os.environ.get('WRITE_BEHIND_MS', 0))  # 0: write-through
+DEBUG_DUMP_DIR = os.environ.get('DEBUG_DUMP_DIR', tempfile.gettempdir())
+DEBUG_DUMPS = max(1, int(os.environ.get('DEBUG_DUMPS', 3)))  # files kept
 
 
 CAPTCHA_TIMER = datetime.timedelta(minutes=5)
@@ -60,22 +82,31 @@ DELTA_DELETE_ADMISSIONS = datetime.timedelta(days=1)
 
 SPAM_STRIKES_LIMIT = 3
 
+LIVE_CAPTCHAS_SIZE = 65536
 
-TLD = (r'(?i:com|net|io|me|org|red|info|tools|mobi|xyz|biz|pro|blog|zip|link|to|kim|'
-       r'review|country|cricket|science|work|party|g[dql]|jobs|c[co]|i[en]|ly|name)')
-URL_MAIL = r'(?P<I>(?i:[ωw]+\.|[/@]))?WORD\.(?(I)WORD|TLD)'
-URL_MAIL = URL_MAIL.replace('WORD', r'[^\s.]+').replace('TLD', TLD)
-URL_MAIL_SEARCH = re.compile(URL_MAIL).search
-INVISIBLE = '\u2061\u2062\u2063\u2064'
-SPACE = ('\u0020\u00a0\u2002\u2003\u2004\u2005\u2006\u2007\u2008\u2009\u200a'
-         '\u202f\u205f\u3000\u200b\ufeff')
+MEMORY_SIZE = 16384  # users with menus, captcha timers
+MENU_TTL = datetime.timedelta(minutes=15)
+WAIT_TTL = CAPTCHA_TIMER + datetime.timedelta(minutes=1)
+PURGE_INTERVAL = datetime.timedelta(minutes=10)
+
+DIGEST_INTERVAL = datetime.timedelta(minutes=5)
+DIGEST_LIMIT = 50  # events
+
+CHAT_MEMBERS_SIZE = 16384
+CHAT_MEMBERS_TTL = datetime.timedelta(minutes=30)
+
+LANES_INTERVAL = datetime.timedelta(minutes=10)  # log of the queue times
+
+
+url_mail_search = UrlDetector(TLD_FILE, ABUSED_TLD_FILE)
 NOVIS = INVISIBLE + SPACE
 FAKE_NAME = (r'(?i:cuenta\s*eliminada|deleted\s*account|marketing|website|promo\s*'
              r'agent|telegram|tg(vip)?member|^[\sNOVIS]*$)').replace('NOVIS', NOVIS)
+MAX_NAME_LENGTH = 39  # of the raw name, with the invisible characters
+LONG_NAME = 'long name'
 BAN_RULES = (
-    (lambda name: len(name) > 39, 'long name'),
-    (URL_MAIL_SEARCH, 'name with uri'),
-    (re.compile(FAKE_NAME).search, 'fake name'),
+    (url_mail_search, 'name with uri'),
+    (FAKE_NAME, 'fake name'),
 )
 LOG_MSG_UC = 'user=%d in chat=%d %s: %s'
 LOG_MSG_C = 'chat=%d %s: %s'
@@ -96,7 +127,6 @@ GREETING_PLURAL = ('¡Les damos la bienvenida {}! '
                    'En el mensaje anclado están las reglas básicas del grupo.')
 
 NEW_CAPTCHA_TEXT = 'Obtener otro captcha'
-NEW_CAPTCHA_TOKEN = get_token()
 CHANCE_CAPTCHA_TEXT = 'Chat privado'
 CAPTCHA_TEXT = ('Por favor {} resuelve el siguiente captcha '
                 '(una simple operación matemática):\n\n{}\n\nResultado:')
@@ -146,7 +176,44 @@ DTL = '%(asctime)s.%(msecs)03d ' if DATETIME_IN_LOG else ''
 LOGFMT = f'{DTL}%(levelname)-8s %(threadName)-10s %(name)-9s %(lineno)-4d %(message)s'
 logging.basicConfig(level=logging.DEBUG, format=LOGFMT, datefmt=DT_FMT)
 logger = logging.getLogger(__name__)
-context = Contextualizer(ENV_DATABASE)
+context = Contextualizer(ENV_DATABASE, Memory(MEMORY_SIZE, MENU_TTL, WAIT_TTL),
+                         ENV_DATABASE_REPLICA)
+ban_rules = BanRules(BAN_RULES, BAN_RULES_FILE)
+# (chat_id, message_id): user_id, of the captchas waiting for an answer
+live_captchas = LRUCache(LIVE_CAPTCHAS_SIZE, CAPTCHA_TIMER.total_seconds())
+digest = Digest(DEBUG_CHAT_ID, DIGEST_LIMIT)
+# (chat_id, user_id): ChatMember, fed by the updates
+chat_members = LRUCache(CHAT_MEMBERS_SIZE, CHAT_MEMBERS_TTL.total_seconds())
+# Routine changes, written in grouped commits
+writes = WriteBehind(BASE, (User.strikes, Admission.to_greet, Chat.prev_greet_users,
+                            Chat.prev_greet_message_id), WRITE_BEHIND_MS / 1000)
+# Held while a debug dump is written
+debug_dumping = threading.Lock()
+
+
+class Lane(enum.IntEnum):
+    CAPTCHA = 0  # answers and joins
+    SPAM = 1  # messages to delete
+    ROUTINE = 2
+
+
+def get_lane(update):
+    # The verdict of spam is kept in the update for the handler
+    if not isinstance(update, Update) or update.callback_query:
+        return Lane.CAPTCHA
+    message = update.message
+    if not message or message.chat.type == message.chat.PRIVATE:
+        return Lane.ROUTINE
+    if message.new_chat_members or message.left_chat_member:
+        return Lane.CAPTCHA
+    if is_spam_update(update):
+        return Lane.SPAM
+    return Lane.ROUTINE
+
+
+# Bounded: in cluster mode the workers wait and the front answers 429. The
+# updates of a chat already queued keep their lane, and so their order
+update_lanes = LaneQueue(get_lane, Lane, WEBHOOK_QUEUE_SIZE, get_chat_id)
 
 
 class UserRestriction(enum.Enum):
@@ -166,6 +233,7 @@ class DBDelete(enum.IntFlag):
     ADMISSION = 2
     RESTRICTION = 4
     EXPULSION = 8
+    CAPTCHAS = 16  # of the admission
     ADM_RES = ADMISSION | RESTRICTION
 
 
@@ -183,6 +251,31 @@ def get_button(text, data=None, url=None):
     return InlineKeyboardButton(text=text, callback_data=data, url=url)
 
 
+def get_greeting(names):
+    if len(names) == 1:
+        return GREETING_SINGULAR.format(html.escape(names[0]))
+    text = ', '.join(names[:-1]) + AND + names[-1]
+    return GREETING_PLURAL.format(html.escape(text))
+
+
+@flogger
+def get_member(bot, chat_id, user_id):
+    member = chat_members.get((chat_id, user_id))
+    if member is None:
+        member = bot.get_chat_member(chat_id=chat_id, user_id=user_id)
+        chat_members.put((chat_id, user_id), member)
+    return member
+
+
+def set_member(chat_id, user, status=None):
+    # Without status (the user is in the chat) the previous one is kept
+    if status is None:
+        member = chat_members.get((chat_id, user.id))
+        present = member and member.status not in (member.LEFT, member.KICKED)
+        status = member.status if present else ChatMember.MEMBER
+    chat_members.put((chat_id, user.id), ChatMember(user=user, status=status))
+
+
 @flogger
 @run_async
 def restrict_user(bot, chat_id, user_id, restriction, until=0):
@@ -245,40 +338,42 @@ def ban_user(bot, chat_id, user_id, reason, until):
     logger.info(LOG_MSG_UC, user_id, chat_id, action, reason)
 
     # FOR DEBUGGING
-    user = bot.get_chat_member(chat_id=chat_id, user_id=user_id).user
+    user = get_member(bot, chat_id, user_id).user
+    if action == 'ban by':
+        set_member(chat_id, user, ChatMember.KICKED)
     text = f'{action}: {reason}\nchat: {chat.title}\nuser: {user.full_name}'
-    bot.send_message(chat_id=DEBUG_CHAT_ID, text=text)
+    digest.add(bot, 'ban', text)
 
 
 @flogger
 def pass_ban_rules(ctx, user_id, user_full_name):
-    for rule, reason in BAN_RULES:
-        if rule(remove_diacritics(user_full_name or '')):
-            until = datetime.datetime.now() + BANNED_RESTRICTION
-            ban_user(ctx.bot, ctx.cid, user_id, reason, until)
-            delete_from_db(ctx, DBDelete.ADM_RES, user_id=user_id)
-            ctx.dbs.add(Expulsion(chat_id=ctx.cid, user_id=user_id,
-                                  reason=reason, until=until))
-            return False
+    # The length before normalize, that removes the padding
+    if len(user_full_name or '') > MAX_NAME_LENGTH:
+        reason = LONG_NAME
+    else:
+        reason = ban_rules.check(normalize(user_full_name))
+    if reason:
+        until = datetime.datetime.now() + BANNED_RESTRICTION
+        ban_user(ctx.bot, ctx.cid, user_id, reason, until)
+        delete_from_db(ctx, DBDelete.ADM_RES, user_id=user_id)
+        ctx.add_expulsion(chat_id=ctx.cid, user_id=user_id,
+                          reason=reason, until=until)
+        return False
     return True
 
 
 @flogger
-def send_captcha(ctx, mention, message_id=None):
-    change_seed(ctx.cid / 10000 + ctx.uid / 100)
-
+def send_captcha(ctx, user_id, mention, message_id=None):
     captcha, correct_answer, answers = get_captcha(num_answers=6)
-    rows = []
-    for row in [answers[:3], answers[3:]]:
-        cols = []
-        for answer in row:
-            token = get_token()
-            cols.append(get_button(answer, token))
-            if answer == correct_answer:
-                correct_token = token
-        rows.append(cols)
-
-    rows.append([get_button(NEW_CAPTCHA_TEXT, NEW_CAPTCHA_TOKEN)])
+    captcha_id = get_captcha_id()
+    ttl = CAPTCHA_TIMER.total_seconds()
+    buttons = [get_button(answer, get_token(captcha_id, index, user_id, ttl,
+                                            answer == correct_answer))
+               for index, answer in enumerate(answers)]
+    rows = [buttons[:3], buttons[3:]]
+
+    token = get_token(captcha_id, NEW_INDEX, user_id, ttl)
+    rows.append([get_button(NEW_CAPTCHA_TEXT, token)])
 
     parameters = {'text': CAPTCHA_TEXT.format(mention, html.escape(captcha)),
                   'reply_markup': InlineKeyboardMarkup(rows)}
@@ -286,7 +381,15 @@ def send_captcha(ctx, mention, message_id=None):
         message = ctx.edit(message_id=message_id, **parameters)
     else:
         message = ctx.send(**parameters)
-    return correct_token, message.message_id
+    live_captchas.put((ctx.cid, message.message_id), user_id)
+    return captcha_id, message.message_id
+
+
+def forget_captcha(*captchas):
+    # No more answers are accepted
+    for captcha in captchas:
+        if captcha:
+            live_captchas.pop((captcha.chat_id, captcha.message_id))
 
 
 @flogger
@@ -326,11 +429,13 @@ def delete_from_db(ctx, delete, *, chat_id=None, user_id=None):
         #if DBDelete.USER in delete:
         #    items.append(ctx.user)
 
-        if DBDelete.ADMISSION in delete:
+        if delete & (DBDelete.ADMISSION | DBDelete.CAPTCHAS):
             admission = get_from_db(ctx, 'admission', chat_id, user_id)
-            items.append(admission)
+            if DBDelete.ADMISSION in delete:
+                items.append(admission)
             if admission:
                 items.extend(admission.captchas.values())
+                forget_captcha(*admission.captchas.values())
                 if admission.group_captcha:
                     group_captcha_mids.append(admission.group_captcha.message_id)
 
@@ -357,7 +462,9 @@ def delete_from_db(ctx, delete, *, chat_id=None, user_id=None):
 @context
 def captcha_thread(ctx):
     # Waiting time is over to solve captcha
-    ctx.mem.get(ctx.uid, {}).get('wait', {}).pop(ctx.cid, None)
+    ctx.mem.waits.pop((ctx.uid, ctx.cid))
+    forget_captcha(ctx.admission.group_captcha)
+    forget_captcha(ctx.admission.private_captcha)
 
     # Delete group captcha
     mid = ctx.admission.group_captcha.message_id
@@ -379,8 +486,8 @@ def captcha_thread(ctx):
         reason = f'captcha not resolved in time ({status})'
         ban_user(ctx.bot, ctx.cid, ctx.uid, reason, until)
         delete_from_db(ctx, DBDelete.ADM_RES)
-        ctx.dbs.add(Expulsion(chat_id=ctx.cid, user_id=ctx.uid,
-                              reason=reason, until=until))
+        ctx.add_expulsion(chat_id=ctx.cid, user_id=ctx.uid,
+                          reason=reason, until=until)
         delete_message(ctx.bot, ctx.cid, ctx.admission.join_message_id,
                        'delete service message (new user)')
 
@@ -400,11 +507,12 @@ def greeting_thread(ctx):
         if admission.group_captcha.status is not CaptchaStatus.SOLVED:  # XXX
             text = '»»» CaptchaStatus not SOLVED in greeting_thread'
             logger.debug(text)
-            ctx.bot.send_message(chat_id=DEBUG_CHAT_ID, text=text)
+            digest.add(ctx.bot, 'greeting', text)
             continue  # captcha still to be resolved
 
         uid = admission.user_id
-        chatmember = ctx.tgc.get_member(uid)  # can change
+        # The name is the one of the last message or answer of the user
+        chatmember = get_member(ctx.bot, ctx.cid, uid)  # can change
         if chatmember.status not in (chatmember.LEFT, chatmember.KICKED):
             # Status can by: CREATOR, ADMINISTRATOR, MEMBER, RESTRICTED
             user = chatmember.user
@@ -428,31 +536,33 @@ def greeting_thread(ctx):
         delete_from_db(ctx, admission)
 
     if names:
-        prev = (ctx.chat.prev_greet_users or '').strip()
-        sep = ', '
-        num = len(names)
-        if prev or num > 1:
-            if num == 1:
-                text = prev + AND + names[0]
-            else:
-                prev_sep = prev + sep if prev else ''
-                text = prev_sep + sep.join(names[:-1]) + AND + names[-1]
-            text = GREETING_PLURAL.format(html.escape(text))
-        else:
-            text = GREETING_SINGULAR.format(html.escape(names[0]))
-
-        # New welcome
-        message = ctx.send(text=text)
-
-        # Previous welcome
-        delete_message(ctx.bot, ctx.cid, ctx.chat.prev_greet_message_id,
-                       'delete previous greeting')
+        prev_users = ctx.chat.greet_users
+        prev_mid = ctx.chat.prev_greet_message_id
+        users = prev_users + names
+        if len(users) > MAX_GREET_USERS:
+            # Too long, the previous welcome is left as is
+            prev_users = []
+            users = names
+
+        # Welcome, updating the previous one if possible...
+        text = get_greeting(users)
+        message = None
+        action = 'edit greeting'
+        if prev_users and prev_mid:
+            message = ctx.edit(message_id=prev_mid, text=text)
+
+        # ...or a new one
+        if not message:
+            message = ctx.send(text=text)
+            action = 'send greeting'
+            if prev_users:
+                delete_message(ctx.bot, ctx.cid, prev_mid, 'delete previous greeting')
 
         # Save data
-        ctx.chat.prev_greet_users = (prev + sep if prev else '') + sep.join(names)
+        ctx.chat.greet_users = users
         ctx.chat.prev_greet_message_id = message.message_id
         status = f'mid={message.message_id}' if message else False
-        logger.debug(LOG_MSG_C, ctx.cid, 'send greeting', status)
+        logger.debug(LOG_MSG_C, ctx.cid, action, status)
 
 
 # ----------------------------------- #
@@ -477,6 +587,8 @@ def new_user_handler(ctx):
         if uid == ctx.bot.id:
             continue  # ignore myself
 
+        set_member(ctx.cid, new_user, ChatMember.MEMBER)
+
         # It is not necessary to check the expulsions, because Telegram will
         # not allow entry, and if it allows it is because some administrator
         # enabled it
@@ -491,7 +603,8 @@ def new_user_handler(ctx):
             restrict_user(ctx.bot, ctx.cid, user.id, UserRestriction.FULL)
 
             # Sending the captcha to the group
-            token, mid = send_captcha(ctx, html.escape(get_user_mention(new_user)))
+            mention = html.escape(get_user_mention(new_user))
+            captcha_id, mid = send_captcha(ctx, user.id, mention)
             logger.debug(LOG_MSG_UC, ctx.cid, user.id, 'send captcha', bool(mid))
 
             # Start timer
@@ -500,20 +613,21 @@ def new_user_handler(ctx):
                                           context=(ctx.tgc, new_user))
             # Save info
             # ... in memory
-            ctx.mem.setdefault(user.id, {}).setdefault('wait', {})[ctx.cid] = wait
+            ctx.mem.waits.put((user.id, ctx.cid), wait)
             # ... in database
-            delete_from_db(ctx, DBDelete.ADMISSION, user_id=user.id)
-            admission = Admission(join_message_id=ctx.mid,
-                                  join_message_date=ctx.date,
-                                  user=user,
-                                  chat=ctx.chat)
-            captcha = Captcha(message_id=mid,
-                              status=CaptchaStatus.WAITING,
-                              token=token,
-                              location=CaptchaLocation.GROUP,
-                              admission=admission)
-            ctx.dbs.add(admission)
-            ctx.dbs.add(captcha)
+            delete_from_db(ctx, DBDelete.CAPTCHAS, user_id=user.id)
+            admission = ctx.upsert(Admission, ('chat_id', 'user_id'),
+                                   chat_id=ctx.cid,
+                                   user_id=user.id,
+                                   join_message_id=ctx.mid,
+                                   join_message_date=ctx.date,
+                                   to_greet=True)
+            writes.set(admission, 'to_greet', True)  # newer than a pending one
+            ctx.dbs.add(Captcha(message_id=mid,
+                                status=CaptchaStatus.WAITING,
+                                token=captcha_id,
+                                location=CaptchaLocation.GROUP,
+                                admission=admission))
             new = True
         else:
             ban = True
@@ -540,15 +654,19 @@ def left_user_handler(ctx):
         delete_message(ctx.bot, ctx.cid, ctx.mid,
                        'delete service message (left user)')
 
+    set_member(ctx.cid, ctx.tgm.left_chat_member, ChatMember.LEFT)
     user = ctx.get_user(id=ctx.tgm.left_chat_member.id)
 
     # Stop captchas timer
-    wait = ctx.mem.get(user.id, {}).get('wait', {}).pop(ctx.cid, None)
+    wait = ctx.mem.waits.pop((user.id, ctx.cid))
     if wait:
         wait.schedule_removal()
 
     admission = ctx.get_admissions(chat_id=ctx.cid, user_id=user.id)
     if admission:
+        for captcha in admission.captchas.values():
+            forget_captcha(captcha)
+
         # Delete group captcha
         mid = admission.group_captcha.message_id
         if mid:
@@ -566,24 +684,52 @@ def left_user_handler(ctx):
     delete_from_db(ctx, DBDelete.ADM_RES, user_id=user.id)
 
 
+def group_talk_needs_writes(ctx):
+    '''If the message changes more than the columns with write-behind.'''
+    expired = ctx.restriction and ctx.restriction.until <= datetime.datetime.now()
+    # Without write-behind, the greetings to cancel are written directly
+    greetings = not writes.delay and (ctx.chat.prev_greet_users
+                                      or GREET_FROM_MEMBER(ctx.text))
+    return bool(not ctx.user or not ctx.chat  # upserts
+                or is_spam_update(ctx.update)  # strikes and bans
+                or expired  # deletion of the restriction
+                or greetings)
+
+
 @flogger
-@context
+@context.read_only(replica=False)
 def group_talk_handler(ctx):
+    # Most of the messages are checked without waiting for the lock
+    if group_talk_needs_writes(ctx):
+        # pylint: disable=too-many-function-args
+        return group_talk_write_handler(ctx.bot, ctx.update)
+    return group_talk_process(ctx)
+
+
+@flogger
+@context
+def group_talk_write_handler(ctx):
+    return group_talk_process(ctx)
+
+
+@flogger
+def group_talk_process(ctx):
     now = datetime.datetime.now()
+    set_member(ctx.cid, ctx.tgu)
 
     # Spam is not allowed
-    if is_spam(ctx.tgm):
+    if is_spam_update(ctx.update):
         delete_message(ctx.bot, ctx.cid, ctx.mid, 'deleted by spam')
-        ctx.user.strikes += 1
+        writes.increment(ctx.user, 'strikes')
 
         if ctx.user.strikes > SPAM_STRIKES_LIMIT:
             until = now + BANNED_RESTRICTION
             reason = 'spammer'
             ban_user(ctx.bot, ctx.cid, ctx.uid, reason, until)
             delete_from_db(ctx, DBDelete.ADM_RES)
-            ctx.user.strikes = 0
-            ctx.dbs.add(Expulsion(chat_id=ctx.cid, user_id=ctx.uid,
-                                  reason=reason, until=until))
+            writes.set(ctx.user, 'strikes', 0)
+            ctx.add_expulsion(chat_id=ctx.cid, user_id=ctx.uid,
+                              reason=reason, until=until)
             return
 
         mention = html.escape(get_user_mention(ctx.tgu))
@@ -607,7 +753,7 @@ def group_talk_handler(ctx):
     # Or until run out of time limitation
     if ctx.restriction:
         if now < ctx.restriction.until:
-            if not ctx.text or URL_MAIL_SEARCH(ctx.text):
+            if not ctx.text or url_mail_search(normalize(ctx.text)):
                 # Only text allowed at beginning
                 delete_message(ctx.bot, ctx.cid, ctx.mid,
                                'temporarily limited user')
@@ -618,17 +764,36 @@ def group_talk_handler(ctx):
 
     # Cancel greeting grouping
     if ctx.chat.prev_greet_users:
-        ctx.chat.prev_greet_users = None
-        ctx.chat.prev_greet_message_id = None
+        writes.set(ctx.chat, 'prev_greet_users', None)
+        writes.set(ctx.chat, 'prev_greet_message_id', None)
         logger.debug(LOG_MSG_C, ctx.cid, 'group next greeting', False)
 
     # Greeting given by a member of the group
     if GREET_FROM_MEMBER(ctx.text):
         for admission in ctx.get_admissions(chat_id=ctx.cid):
-            admission.to_greet = False
+            writes.set(admission, 'to_greet', False)
         logger.debug(LOG_MSG_C, ctx.cid, 'next greeting', False)
 
 
+def captcha_handler_verify(func):
+    # Forged, expired, of another user or of a captcha that is no longer
+    # waiting: rejected without taking the lock or touching the db
+    @functools.wraps(func)
+    def decorator(bot, update, **kwargs):
+        query = update.callback_query
+        token = None
+        if query.message:
+            key = (query.message.chat_id, query.message.message_id)
+            if live_captchas.get(key) == query.from_user.id:
+                token = check_token(query.data or '', query.from_user.id)
+        if not token:
+            query.answer()
+            logger.debug(LOG_MSG_U, query.from_user.id, 'token', 'rejected')
+            return None
+        return func(bot, update, token=token, **kwargs)
+    return decorator
+
+
 def captcha_handler_answer(func):
     @functools.wraps(func)
     def decorator(ctx):
@@ -639,55 +804,80 @@ def captcha_handler_answer(func):
     return decorator
 
 
-@flogger
-@context
-@captcha_handler_answer
-def captcha_handler(ctx):
+def find_captcha(ctx):
+    '''The captcha answered and the chat of its admission, (None, None) if
+    it does not wait for this answer.'''
     # Searching for origin
     if ctx.is_group:
         cap = ctx.admission.group_captcha
         if cap.message_id != ctx.mid or cap.status is not CaptchaStatus.WAITING:
-            return None  # this captcha is from another user or already resolved
+            return None, None  # this captcha is from another user or already resolved
         captcha = cap
         chat_id = ctx.admission.chat_id
 
     elif ctx.is_private:
         # Search which group the captcha corresponds to
-        for admission in ctx.get_admissions(user_id=ctx.uid):
-            cap = admission.private_captcha
-            if cap.message_id == ctx.mid and cap.status is CaptchaStatus.WAITING:
-                captcha = cap
-                chat_id = admission.chat_id
-                break
-        else:
-            return None  # the time to be finished
+        captcha = ctx.get_captcha(chat_id=ctx.cid, message_id=ctx.mid,
+                                  location=CaptchaLocation.PRIVATE)
+        if captcha.status is not CaptchaStatus.WAITING:
+            return None, None  # the time to be finished
+        chat_id = captcha.admission.chat_id
 
     else:
-        return None  # not implemented for channels
+        return None, None  # not implemented for channels
 
-    token = ctx.update.callback_query.data or ''
+    if not captcha.is_current(ctx.token.captcha_id):
+        return None, None  # buttons of a captcha already replaced
+    return captcha, chat_id
+
+
+@flogger
+@captcha_handler_verify
+@context.read_only(replica=False)
+def captcha_handler(ctx):
+    # The answers to captchas resolved or replaced do not wait for the lock
+    captcha, _ = find_captcha(ctx)
+    if not captcha:
+        ctx.update.callback_query.answer()
+        logger.debug(LOG_MSG_UC, ctx.uid, ctx.cid, 'captcha handler', None)
+        return None
+    # pylint: disable=too-many-function-args,unexpected-keyword-arg
+    return captcha_write_handler(ctx.bot, ctx.update, token=ctx.token)
+
+
+@flogger
+@context
+@captcha_handler_answer
+def captcha_write_handler(ctx):
+    captcha, chat_id = find_captcha(ctx)  # again, with the lock
+    if not captcha:
+        return None
+
+    set_member(chat_id, ctx.tgu)  # current name, checked before the greeting
     mention = html.escape(get_user_mention(ctx.tgu))
 
     # New captcha
-    if hmac.compare_digest(token, NEW_CAPTCHA_TOKEN):
+    if ctx.token.index == NEW_INDEX:
         logger.debug(LOG_MSG_U, ctx.uid, 'token', 'new')
 
-        token, mid = send_captcha(ctx, mention, captcha.message_id)
+        captcha_id, mid = send_captcha(ctx, ctx.uid, mention, captcha.message_id)
         logger.debug(LOG_MSG_UC, ctx.cid, ctx.uid, 'send captcha', bool(mid))
-        captcha.token = token
+        captcha.token = captcha_id
         return None  # nothing else for now
 
     # Correct answer
-    if captcha.is_correct(token):
+    if ctx.token.correct:
         logger.debug(LOG_MSG_U, ctx.uid, 'token', 'correct')
 
         captcha.status = CaptchaStatus.SOLVED
+        forget_captcha(captcha)
         text = SOLVED_CAPTCHA_TEXT1.format(mention)
 
         if ctx.is_private:
             # Modify the captcha of the group as well
             g_captcha = captcha.admission.group_captcha
             g_captcha.status = CaptchaStatus.SOLVED
+            forget_captcha(g_captcha)
             ctx.edit(chat_id=chat_id, message_id=g_captcha.message_id, text=text)
             text = SOLVED_CAPTCHA_TEXT2
 
@@ -695,14 +885,15 @@ def captcha_handler(ctx):
 
         # Accepted but temporarily limited
         until = datetime.datetime.now() + TEMPORARY_RESTRICTION
-        delete_from_db(ctx, DBDelete.RESTRICTION, chat_id=chat_id)
-        ctx.dbs.add(Restriction(chat_id=chat_id, user_id=ctx.uid, until=until))
+        ctx.upsert(Restriction, ('chat_id', 'user_id'),
+                   chat_id=chat_id, user_id=ctx.uid, until=until)
         restrict_user(ctx.bot, chat_id, ctx.uid, UserRestriction.TEMP, until)
         return SOLVED_CAPTCHA_ALERT
 
     # Wrong answer
     logger.debug(LOG_MSG_U, ctx.uid, 'token', 'wrong')
     captcha.status = CaptchaStatus.WRONG
+    forget_captcha(captcha)
     if ctx.is_group:
         # Link to second opportunity
         url = f't.me/{ctx.bot.username}?start={ctx.tgu.id}'
@@ -723,8 +914,9 @@ def captcha_handler(ctx):
 
 
 @flogger
-@context
+@context.read_only(replica=False)
 def menu_handler(ctx):
+    # Not in the replica: the wrong answer that leads here was just written
     now = datetime.datetime.now()
 
     wrongs = {}
@@ -736,21 +928,20 @@ def menu_handler(ctx):
             title = html.escape(admission.chat.title)
             wrongs[f'{len(wrongs)+1}• {title}'] = admission.chat_id
     if wrongs:
-        ctx.mem.setdefault(ctx.uid, {})['menu'] = wrongs
+        ctx.mem.menus.put(ctx.uid, wrongs)
         keyboard = ReplyKeyboardMarkup([[YES, NO]], **KEYBOARD_COMMON)
         message = ctx.send(text=START_MENU_TEXT1, reply_markup=keyboard)
         logger.debug(LOG_MSG_P, ctx.uid, 'start menu', bool(message))
         return MenuStep.INIT
 
-    waits = set()
-    for expulsion in ctx.get_expulsions(user_id=ctx.uid):
-        wait = expulsion.until - now
-        if wait.total_seconds() > 0:
-            waits.add('• {}{}"{}"'.format(time_to_text(wait),
-                                          FOR,
-                                          html.escape(expulsion.chat.title)))
+    waits = {}
+    for expulsion in ctx.get_active_expulsions(user_id=ctx.uid, now=now):
+        if expulsion.chat_id not in waits:  # the longest of each chat
+            waits[expulsion.chat_id] = '• {}{}"{}"'.format(
+                time_to_text(expulsion.until - now), FOR,
+                html.escape(expulsion.chat.title))
     if waits:
-        text = START_MENU_TEXT2.format('\n'.join(sorted(waits)))
+        text = START_MENU_TEXT2.format('\n'.join(sorted(waits.values())))
         keyboard = ReplyKeyboardRemove()
         message = ctx.send(text=text, reply_markup=keyboard)
         logger.debug(LOG_MSG_P, ctx.uid, 'must wait', bool(message))
@@ -764,7 +955,7 @@ def menu_handler(ctx):
 @flogger
 @context
 def init_handler(ctx):
-    wrongs = ctx.mem.get(ctx.uid, {}).get('menu')
+    wrongs = ctx.mem.menus.get(ctx.uid)
     if wrongs:
         if len(wrongs) > 1:
             keyboard = ReplyKeyboardMarkup([[key] for key in wrongs],
@@ -794,16 +985,16 @@ def chat_handler(ctx):
 
 @flogger
 def chat_process(ctx, key):
-    chat_id = ctx.mem.get(ctx.uid, {}).get('menu').get(key)
+    chat_id = (ctx.mem.menus.get(ctx.uid) or {}).get(key)
     if chat_id:
-        ctx.mem.get(ctx.uid, {}).pop('menu', None)
+        ctx.mem.menus.pop(ctx.uid)
 
         mention = html.escape(get_user_mention(ctx.tgu))
-        token, mid = send_captcha(ctx, mention)
+        captcha_id, mid = send_captcha(ctx, ctx.uid, mention)
         admission = ctx.get_admissions(chat_id=chat_id, user_id=ctx.uid)
         ctx.dbs.add(Captcha(message_id=mid,
                             status=CaptchaStatus.WAITING,
-                            token=token,
+                            token=captcha_id,
                             location=CaptchaLocation.PRIVATE,
                             admission=admission))
 
@@ -821,7 +1012,7 @@ def stop_handler(ctx):
 
 @flogger
 def stop_process(ctx):
-    ctx.mem.get(ctx.uid, {}).pop('menu', None)
+    ctx.mem.menus.pop(ctx.uid)
     message = ctx.send(text=CANCEL_MENU_TEXT, reply_markup=ReplyKeyboardRemove())
     logger.debug(LOG_MSG_P, ctx.uid, 'cancel menu', bool(message))
     return MenuStep.STOP
@@ -853,18 +1044,60 @@ def dc_db_handler(ctx):
 
 @flogger
 @context
-def debug_handler(ctx):
-    from pprint import pformat
+def reload_rules_handler(ctx):
+    if ctx.is_private and ctx.text.split(None, 1)[-1] == SECRET_PHRASE.decode():
+        # The TLDs first, loading the rules also clears the memoized verdicts
+        result = (url_mail_search.load(), ban_rules.load())
+        logger.info('ban rules reloaded: %s', result)
+    else:
+        logger.info('SECRET PHRASE: %s', SECRET_PHRASE.decode())
+
+
+@flogger
+@run_async
+def debug_handler(bot, update):
+    # One dump at a time, in its own thread and session
+    if not debug_dumping.acquire(blocking=False):  # pylint: disable=consider-using-with
+        logger.info('debug dump already running')
+        return
+    try:
+        debug_dump(bot, update)  # pylint: disable=too-many-function-args
+    finally:
+        debug_dumping.release()
 
-    texts = []
-    for model in (User, Chat, Admission, Restriction, Expulsion):
-        rows = '\n'.join(f'• {str(row)}' for row in ctx.dbs.query(model).all())
-        if rows:
-            texts.append(rows)
 
-    logger.debug('DEBUGGING:\n\nMEM:\n%s\n\nDB:\n%s\n',
-                 pformat(ctx.mem),
-                 '\n\n'.join(texts))
+@flogger
+@context.read_only
+def debug_dump(ctx):
+    models = (User, Chat, Admission, Restriction, Expulsion)
+    tables = {model.__tablename__: {'rows': dump.get_count(ctx.dbs, model),
+                                    'bytes': dump.get_size(ctx.dbs, model)}
+              for model in models}
+    path = os.path.join(DEBUG_DUMP_DIR,
+                        f'debug-{datetime.datetime.now():%Y%m%d-%H%M%S}.txt')
+    logger.info('DEBUGGING to %s, MEM %s, DB %s', path, ctx.mem.sizes, tables)
+
+    # With the ids and names of the users
+    with dump.open_private(path) as file:
+        file.write(f'MEM {ctx.mem.sizes}\nDB {tables}\n')
+        for model in models:
+            file.write(f'\nDB {model.__tablename__}:\n')
+            dump.write_rows(ctx.dbs, model, file)
+
+        for name, items in ctx.mem.to_dict().items():
+            file.write(f'\nMEM {name}:\n')
+            for key, value in items.items():
+                file.write(f'• {key}: {value}\n')
+
+        file.write(f'\nSPAM ({len(SPAMS)} cached):\n')
+        for fingerprint, sample, hits in SPAMS.hottest():
+            file.write(f'• {hits} {fingerprint} {sample!r}\n')
+
+        file.write('\nLANES:\n')
+        for name, stats in update_lanes.to_dict().items():
+            file.write(f'• {name}: {stats}\n')
+    logger.info('DEBUGGING done: %s, %d old removed', path,
+                dump.prune(DEBUG_DUMP_DIR, DEBUG_DUMPS))
 
 
 # ----------------------------------- #
@@ -874,8 +1107,8 @@ def error_handler(bot, update, error):
     text = 'UPDATE  {}  CAUSED ERROR  {}'.format(update, error)
     logger.critical(text)
 
-    # FOR DEBUGGING
-    bot.send_message(chat_id=DEBUG_CHAT_ID, text=text)
+    # FOR DEBUGGING (without the update, to group the same errors)
+    digest.add(bot, 'error', f'{error.__class__.__name__}: {error}')
 
 
 def get_handler(data):
@@ -886,14 +1119,43 @@ def get_handler(data):
     return handlers
 
 
-def main(polling, clean):
-    logger.info('Initializing bot...')
+def flush_writes(bot=None, job=None):
+    # pylint: disable=unused-argument
+    with context.batch() as dbs:
+        writes.flush(dbs)
+
+
+def shutdown():
+    try:
+        flush_writes()
+    except Exception:  # pylint: disable=broad-except
+        logger.exception('pending writes lost')
+
+
+def get_updater(partition=None):
+    # The partition (of chats) is only used in cluster mode
     updater = Updater(TOKEN)
-    context.initialize(updater.bot, DELTA_DELETE_ADMISSIONS)
+    if partition:
+        context.initialize(updater.bot, DELTA_DELETE_ADMISSIONS, live_captchas,
+                           clean=partition.index == 0, owns=partition.owns,
+                           create=False)
+    else:
+        context.initialize(updater.bot, DELTA_DELETE_ADMISSIONS, live_captchas)
     dis = updater.dispatcher
+    # Before starting, both share the queue of updates
+    updater.update_queue = dis.update_queue = update_lanes
+    if BATCH_WINDOW_MS:
+        # The updates of a group share the transaction, one savepoint each
+        dis.process_update = get_batcher(dis.process_update, update_lanes,
+                                         context.batch, BATCH_WINDOW_MS / 1000,
+                                         BATCH_SIZE)
 
     dis.add_handler(CommandHandler('dc_db', dc_db_handler, Filters.private))
-    dis.add_handler(CommandHandler('debug', debug_handler, Filters.private))
+    # Only from the chat of debugging, the dump contains users data
+    dis.add_handler(CommandHandler('debug', debug_handler,
+                                   Filters.chat(DEBUG_CHAT_ID)))
+    dis.add_handler(CommandHandler('reload_rules', reload_rules_handler,
+                                   Filters.private))
 
     # Group handlers
     dis.add_handler(CommandHandler('start', help_handler, ~Filters.private))
@@ -922,19 +1184,57 @@ def main(polling, clean):
     ))
 
     dis.add_error_handler(error_handler)
+    updater.job_queue.run_repeating(digest.flush, DIGEST_INTERVAL.total_seconds())
+    updater.job_queue.run_repeating(context.mem.purge, PURGE_INTERVAL.total_seconds())
+    updater.job_queue.run_repeating(update_lanes.log, LANES_INTERVAL.total_seconds())
+    if writes.delay:
+        updater.job_queue.run_repeating(flush_writes, writes.delay)
+    return updater
+
+
+def get_seen():
+    # In cluster mode, called after starting the workers (no shared connections)
+    return SeenUpdates(SEEN_UPDATES_SIZE,
+                       load=functools.partial(context.load_mark, 'update_id'),
+                       save=functools.partial(context.save_mark, 'update_id'))
+
+
+def main(polling, clean, workers):
+    logger.info('Initializing bot...')
+    if workers:
+        # Webhook front and processes partitioned by chat, the schema is
+        # created once, before starting them
+        context.create_tables()
+        cluster.run(get_updater, workers, TOKEN, HOST, BIND, PORT, WEBHOOK_QUEUE_SIZE,
+                    get_seen, shutdown)
+        return
+
+    updater = get_updater()
 
     # Mode
     if polling:
         updater.start_polling(clean=clean)
         logger.info('start in polling mode, clean=%s', clean)
-    else:
-        # start_webhook: only set webhook if SSL is handled by library
-        updater.bot.set_webhook('{}/{}'.format(HOST, TOKEN))
-        # cleaning updates is not supported if SSL-termination happens elsewhere
-        updater.start_webhook(listen=BIND, port=PORT, url_path=TOKEN)
-        logger.info('start in webhook mode')
-    # Wait...
-    updater.idle()
+        # Wait...
+        updater.idle()
+        shutdown()
+        return
+
+    # The updates are acknowledged once queued, the dispatcher drains them
+    seen = get_seen()
+    ingestion = webhook.Ingestion(
+        (updater.update_queue,), WEBHOOK_QUEUE_SIZE, seen=seen,
+        convert=lambda data, raw: Update.de_json(data, updater.bot))
+    thread = webhook.start_dispatcher(updater)
+    # set_webhook: SSL-termination happens elsewhere
+    updater.bot.set_webhook('{}/{}'.format(HOST, TOKEN))
+    logger.info('start in webhook mode')
+    try:
+        webhook.serve(ingestion, TOKEN, BIND, PORT)
+    finally:
+        seen.flush()
+        webhook.stop_dispatcher(updater, thread)
+        shutdown()
 
 
 def run():
@@ -949,6 +1249,11 @@ def run():
         '-c', '--clean',
         help='clean any pending updates',
         action='store_true')
+    parser.add_argument(
+        '-w', '--workers',
+        help='number of processes, partitioned by chat (webhook mode only)',
+        type=int,
+        default=0)
     parser.add_argument(
         '-v', '--verbose',
         help='verbose level, repeat up to three times',
@@ -974,7 +1279,9 @@ def run():
         for logger_name in logger_names:
             logging.getLogger(logger_name).setLevel(logging.WARNING)
 
-    main(args.polling, args.clean)
+    if args.workers and args.polling:
+        parser.error('workers are only available in webhook mode')
+    main(args.polling, args.clean, args.workers)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,96 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2019 Schmidt Cristian Hernán
+
+import re
+import json
+import logging
+import functools
+import itertools
+import threading
+
+CACHE_SIZE = 2048
+
+
+class BanRules:
+
+    '''Ban rules compiled into few matchers with memoized verdicts.
+
+    The rules are pairs of (rule, reason), where the rule can be a regex
+    pattern or a function that receives the name. The consecutive patterns
+    are joined in one regex that keeps the order of the rules. The extra
+    rules of the file (a JSON list of [pattern, reason]) are added after the
+    default ones every time `load` is called.
+    '''
+
+    __slots__ = ('logger', 'lock', 'rules', 'path', 'size', 'steps', 'check')
+
+    def __init__(self, rules, path=None):
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.rules = tuple(rules)
+        self.path = path
+        self.size = 0
+        self.steps = ()
+        self.check = None
+        self.load()
+
+    def __repr__(self):
+        return f'«{self.__class__.__name__}:{self.size}»'
+
+    def load(self):
+        '''(Re)compile the rules, on error the previous ones are kept.'''
+        rules = list(self.rules)
+        try:
+            if self.path:
+                with open(self.path, encoding='utf-8') as file:
+                    for pattern, reason in json.load(file):
+                        if not isinstance(pattern, str) or not isinstance(reason, str):
+                            raise TypeError(f'invalid rule: {pattern!r}, {reason!r}')
+                        rules.append((pattern, reason))
+            steps = get_steps(rules)
+
+        except (OSError, ValueError, TypeError, re.error) as error:
+            self.logger.error('ban rules not loaded: %s', error)
+            return False
+
+        with self.lock:
+            self.size = len(rules)
+            self.steps = steps
+            self.check = functools.lru_cache(maxsize=CACHE_SIZE)(self._check)
+        self.logger.info('ban rules loaded: %d', len(rules))
+        return True
+
+    def _check(self, name):
+        '''Return the reason of the first rule fired or None.'''
+        for step, reason in self.steps:
+            if isinstance(reason, dict):
+                match = step(name)
+                if match:
+                    return reason[match.lastgroup]
+            elif step(name):
+                return reason
+        return None
+
+
+def get_steps(rules):
+    '''(search, {group: reason}) by consecutive patterns, (func, reason).'''
+    steps = []
+    kinds = itertools.groupby(rules, lambda rule: isinstance(rule[0], str))
+    for is_pattern, group in kinds:
+        if not is_pattern:
+            for func, reason in group:
+                if not callable(func):
+                    raise TypeError(f'invalid rule: {func!r}, {reason!r}')
+                steps.append((func, reason))
+            continue
+
+        # Each pattern in a lookahead from the start: the alternatives are
+        # tried in order over the whole name, as separate searches would be
+        patterns = []
+        reasons = {}
+        for pattern, reason in group:
+            name = f'rule{len(reasons)}'
+            patterns.append(f'(?=[\\s\\S]*?(?P<{name}>{pattern}))')
+            reasons[name] = reason
+        steps.append((re.compile(r'\A(?:' + '|'.join(patterns) + ')').match, reasons))
+    return tuple(steps)
@@ -2,6 +2,10 @@
 # Copyright (C) 2019 Schmidt Cristian Hernán
 
 import re
+import hashlib
+import operator
+
+from tools import normalize, LRUCache
 
 CHECKOUT = (
     'caption',
@@ -12,58 +16,65 @@ CHECKOUT = (
     'forward_sender_name',
     'text',
 )
+GETTERS = tuple(operator.attrgetter(checkout) for checkout in CHECKOUT)
 
-LETTER_MAP = {
-    'a': '\u1972\u1d00',
-    'b': '\u0412',
-    'c': '\u1d04\u0421',
-    'd': '\u0274',
-    'e': '\u1971\u1d07\u0415',
-    'f': '\u0493',
-    'g': '\u0262',
-    'h': '',
-    'i': '\u03b9\u026a',
-    'j': '',
-    'k': '\u1d0b',
-    'l': '\u1963\u029f',
-    'm': '\u043c',
-    'n': '\u1952\u0274',
-    'o': '\u1d0f',
-    'p': '',
-    'q': '',
-    'r': '\u0280',
-    's': '',
-    't': '\u0442\u1d1b',
-    'u': '\u1d1c',
-    'v': '',
-    'w': '\u1d21\u03c9',
-    'x': '\u0425',
-    'y': '',
-    'z': '',
-}
-
-def flex(char):
-    if char in LETTER_MAP:
-        return f'[{char}{LETTER_MAP[char]}]'
-    return char
+CACHE_SIZE = 4096
+SAMPLE_SIZE = 40
+VERDICT_ATTR = '_is_spam'  # cached in the update, like its _effective_*
 
 SKETCH = '(tg(vip)?member|telegram marketing)'
 
-PATTERN = ''.join((f'{flex(c)}\\s*' if c.isalpha() else c) for c in SKETCH)
+# The text is normalized before, so homoglyphs and invisible characters
+# do not need to be considered here
+PATTERN = ''.join((f'{c}\\s*' if c.isalpha() else c) for c in SKETCH)
 SPAMMER_RE = re.compile(PATTERN.replace(r'\s* ', r'\s+'), re.IGNORECASE)
 
-def is_spam(message):
-    for checkout in CHECKOUT:
+
+# fingerprint: sample, of the spam, with its hits
+SPAMS = LRUCache(CACHE_SIZE, count_hits=True)
+# fingerprint: True, of the rest, apart so the chatter does not evict the spam
+CLEAN = LRUCache(CACHE_SIZE)
+
+
+def get_contents(message):
+    contents = []
+    for getter in GETTERS:
         try:
-            attrs = iter(checkout.split('.'))
-            obj = message
-            while True:
-                try:
-                    obj = getattr(obj, next(attrs))
-                except StopIteration:
-                    break
-            if SPAMMER_RE.match(str(obj or '')):
-                return True
+            contents.append(str(getter(message) or ''))
         except AttributeError:
-            pass
+            contents.append('')
+    return contents
+
+
+def get_fingerprint(contents):
+    data = '\0'.join(contents).encode('utf-8', 'surrogatepass')
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def is_spam(message):
+    contents = get_contents(message)
+    if not any(contents):
+        return False
+
+    fingerprint = get_fingerprint(contents)
+    if SPAMS.get(fingerprint) is not None:
+        return True
+    if CLEAN.get(fingerprint):
+        return False
+
+    if any(SPAMMER_RE.match(normalize(content)) for content in contents):
+        sample = next(content for content in contents if content)
+        SPAMS.put(fingerprint, sample[:SAMPLE_SIZE])
+        return True
+    CLEAN.put(fingerprint, True)
     return False
+
+
+def is_spam_update(update):
+    '''is_spam of the message of the update, only computed once.'''
+    spam = getattr(update, VERDICT_ATTR, None)
+    if spam is None:
+        message = update.effective_message
+        spam = bool(message) and is_spam(message)
+        setattr(update, VERDICT_ATTR, spam)
+    return spam
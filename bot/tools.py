@@ -5,12 +5,14 @@ import os
 import time
 import hmac
 import base64
+import operator
 import string
 import random
 import secrets
 import datetime
 import itertools
 import functools
+import collections
 import threading
 import unicodedata
 
@@ -18,28 +20,91 @@ import unicodedata
 DT_FMT = '%y%m%d.%H%M%S'
 CHARACTERS = string.digits + string.ascii_letters
 SECRET_PHRASE = ''.join(secrets.choice(CHARACTERS) for _ in range(9)).encode()
-BASE64_ALTCHARS = ''.join(secrets.choice(CHARACTERS) for _ in range(2)).encode()
+# Must survive restarts, otherwise the buttons of pending captchas stop working
+SIGNING_KEY = (os.environ.get('SIGNING_KEY') or
+               os.environ.get('TELEGRAM_TOKEN', '')).encode() or SECRET_PHRASE
+SIGNATURE_SIZE = 12  # bytes, 16 characters in base64
+NEW_INDEX = 'n'
+LOCAL = threading.local()
+
+INVISIBLE = ('\u00ad\u200b\u200c\u200d\u2060\u2061\u2062\u2063\u2064'
+             '\u180e\ufeff')
+SPACE = ('\u0020\u00a0\u2002\u2003\u2004\u2005\u2006\u2007\u2008\u2009'
+         '\u200a\u202f\u205f\u3000')
+
+# Characters that look like a latin letter but are not decomposed by NFKD
+CONFUSABLES = {
+    'a': '\u1972\u1d00\u0430\u03b1',
+    'A': '\u0410\u0391',
+    'B': '\u0412\u0392\u0299',
+    'c': '\u1d04\u0441',
+    'C': '\u0421',
+    'd': '\u0501',
+    'e': '\u1971\u1d07\u0435',
+    'E': '\u0415\u0395',
+    'f': '\u0493',
+    'g': '\u0262\u0261',
+    'h': '\u04bb\u043d\u029c',
+    'H': '\u041d\u0397',
+    'i': '\u03b9\u026a\u0456\u0131',
+    'I': '\u0406\u0399\u04c0',
+    'j': '\u0458',
+    'J': '\u0408',
+    'k': '\u1d0b\u03ba\u043a',
+    'K': '\u041a\u039a',
+    'l': '\u1963\u029f',
+    'm': '\u043c\u1d0d',
+    'M': '\u041c\u039c',
+    'n': '\u1952\u0274\u03b7',
+    'N': '\u039d',
+    'o': '\u1d0f\u043e\u03bf',
+    'O': '\u041e\u039f',
+    'p': '\u0440\u03c1\u1d18',
+    'P': '\u0420\u03a1',
+    'q': '\u051b',
+    'r': '\u0280\u0433',
+    's': '\u0455\ua731',
+    'S': '\u0405',
+    't': '\u0442\u1d1b\u03c4',
+    'T': '\u0422\u03a4',
+    'u': '\u1d1c\u03c5',
+    'v': '\u03bd\u1d20\u0475',
+    'w': '\u1d21\u03c9\u0461',
+    'x': '\u0445\u03c7',
+    'X': '\u0425\u03a7',
+    'y': '\u0443\u028f\u03b3',
+    'Y': '\u04ae\u03a5',
+    'z': '\u1d22',
+    'Z': '\u0396',
+}
 
 
 class Sentinel:
 
+    '''Falsy object that absorbs any use, there is only one instance.'''
+
+    __slots__ = ()
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
     def __repr__(self):
         return f'«{self.__class__.__name__}»'
 
     def __bool__(self):
         return False
 
-    def __hash__(self):
-        return hash(object())
-
     def __call__(self, *arg, **kwargs):
-        return Sentinel()
+        return self
 
     def __getattr__(self, name):
-        return Sentinel()
+        return self
 
-    #def __setattr__(self, name, value):
-    #    return None
+    def __setattr__(self, name, value):
+        return None
 
     #def __delattr__(self, name):
     #    return None
@@ -54,6 +119,92 @@ class Sentinel:
     #    return None
 
 
+SENTINEL = Sentinel()
+
+
+class LRUCache:
+
+    '''Thread safe mapping with a size limit and optional time to live.
+
+    With `count_hits` the gets of each key are counted while it is cached.
+    '''
+
+    __slots__ = ('lock', 'size', 'ttl', 'items', 'hits')
+
+    def __init__(self, size, ttl=None, count_hits=False):
+        self.lock = threading.Lock()
+        self.size = size
+        self.ttl = ttl  # seconds
+        self.items = collections.OrderedDict()  # key: (expiry, value)
+        self.hits = {} if count_hits else None  # key: gets
+
+    def __repr__(self):
+        return f'«{self.__class__.__name__}:{len(self.items)}»'
+
+    def __len__(self):
+        return len(self.items)
+
+    def _remove(self, key):
+        # Called with the lock
+        item = self.items.pop(key, None)
+        if self.hits is not None:
+            self.hits.pop(key, None)
+        return item
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return default
+            if item[0] and item[0] < time.monotonic():
+                self._remove(key)
+                return default
+            self.items.move_to_end(key)
+            if self.hits is not None:
+                self.hits[key] = self.hits.get(key, 0) + 1
+            return item[1]
+
+    def put(self, key, value):
+        expiry = time.monotonic() + self.ttl if self.ttl else 0
+        with self.lock:
+            self.items[key] = (expiry, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self._remove(next(iter(self.items)))
+
+    def pop(self, key, default=None):
+        with self.lock:
+            item = self._remove(key)
+        return default if item is None else item[1]
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            if self.hits is not None:
+                self.hits.clear()
+
+    def purge(self):
+        '''Remove the expired items, return how many were removed.'''
+        now = time.monotonic()
+        with self.lock:
+            expired = [key for key, (expiry, _) in self.items.items()
+                       if expiry and expiry < now]
+            for key in expired:
+                self._remove(key)
+        return len(expired)
+
+    def to_dict(self):
+        with self.lock:
+            return {key: value for key, (_, value) in self.items.items()}
+
+    def hottest(self, num=10):
+        '''The keys with more hits: [(key, value, hits)], with count_hits.'''
+        with self.lock:
+            items = [(key, value, self.hits.get(key, 0))
+                     for key, (_, value) in self.items.items()]
+        return sorted(items, key=operator.itemgetter(2), reverse=True)[:num]
+
+
 def _name(name):
     return (name or '').strip()
 
@@ -96,18 +247,54 @@ def run_async(func):
     return decorator
 
 
-def get_token():
-    '''Generate a token ensuring that it does not repeat.'''
-    stamp = int(time.time() * 1e8).to_bytes(9, byteorder='big')
-    digest = hmac.digest(SECRET_PHRASE, stamp, 'sha256')
-    token = base64.b64encode(digest, altchars=BASE64_ALTCHARS).decode()
-    return token.rstrip('=')
+CaptchaToken = collections.namedtuple('CaptchaToken', 'captcha_id index correct')
+
 
+def get_captcha_id():
+    '''Generate an identifier for a captcha ensuring that it does not repeat.'''
+    return secrets.token_urlsafe(6)
 
-def change_seed(num=0):
-    '''Random seed change, improves randomness.'''
-    seed = time.time() + int.from_bytes(os.urandom(4), byteorder='big')
-    random.seed(seed + float(num or 0))
+
+def _sign(captcha_id, index, expiry, user_id, correct):
+    msg = f'{captcha_id}.{index}.{expiry}.{user_id}.{int(correct)}'.encode()
+    digest = hmac.digest(SIGNING_KEY, msg, 'sha256')[:SIGNATURE_SIZE]
+    return base64.urlsafe_b64encode(digest).decode()
+
+
+def get_token(captcha_id, index, user_id, ttl, correct=False):
+    '''Signed data for a captcha button (callback_data, up to 64 bytes).
+
+    The correctness of the answer and the user who must press the button
+    are only part of the signature, they can not be read from the token.
+    '''
+    expiry = int(time.time() + ttl)
+    signature = _sign(captcha_id, index, expiry, user_id, correct)
+    return f'{captcha_id}.{index}.{expiry}.{signature}'
+
+
+def check_token(data, user_id):
+    '''Return a CaptchaToken or None if it is forged, expired or of another user.'''
+    try:
+        captcha_id, index, expiry, signature = data.split('.')
+        expired = int(expiry) < time.time()
+    except ValueError:
+        return None
+    if expired:
+        return None
+    for correct in (True, False):
+        if hmac.compare_digest(signature, _sign(captcha_id, index, expiry,
+                                                user_id, correct)):
+            return CaptchaToken(captcha_id, index, correct)
+    return None
+
+
+def get_random():
+    '''Random generator of the current thread (seeded from os.urandom).'''
+    try:
+        return LOCAL.random
+    except AttributeError:
+        LOCAL.random = random.Random()
+        return LOCAL.random
 
 
 def remove_diacritics(text):
@@ -116,6 +303,46 @@ def remove_diacritics(text):
     return ''.join(c for c in nfkd if unicodedata.category(c) != 'Mn')
 
 
+class TranslationTable(dict):
+    '''Table for `str.translate`, characters not yet seen are resolved once.'''
+
+    def __init__(self):
+        super().__init__()
+        for char in range(128):
+            self[char] = chr(char)
+        for char in range(128, 0x250):  # Latin-1 Supplement and Extended-A/B
+            self[char] = self.resolve(chr(char))
+        for char in INVISIBLE:
+            self[ord(char)] = None
+        for char in SPACE:
+            self[ord(char)] = ' '
+        for letter, chars in CONFUSABLES.items():
+            for char in chars:
+                self[ord(char)] = letter
+
+    def __repr__(self):
+        return f'«{self.__class__.__name__}:{len(self)}»'
+
+    def __missing__(self, key):
+        value = self.resolve(chr(key))
+        self[key] = value
+        return value
+
+    @staticmethod
+    def resolve(char):
+        text = remove_diacritics(char)
+        return ''.join(CONFUSABLES_MAP.get(c, c) for c in text) or None
+
+
+CONFUSABLES_MAP = {c: letter for letter, chars in CONFUSABLES.items() for c in chars}
+TRANSLATION_TABLE = TranslationTable()
+
+
+def normalize(text):
+    '''Plain text without confusables, diacritics and invisible characters.'''
+    return (text or '').translate(TRANSLATION_TABLE)
+
+
 def time_to_text(delta):
     if isinstance(delta, (int, float)):
         delta = datetime.timedelta(seconds=delta)
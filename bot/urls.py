@@ -0,0 +1,104 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2019 Schmidt Cristian Hernán
+'''Detection of URLs and e-mails in names and messages.
+
+All the TLDs are used only when the host is followed by a path, query or
+port, or has a prefix. A bare host (spam.xyz) is only taken as such if its
+TLD is in the list of the abused ones: with all the TLDs many names and
+words (Dr.House, esto.es) would be taken as hosts and banned or deleted,
+at the cost of letting through the bare hosts of other TLDs. Both lists
+are data files, reloaded with the ban rules.
+'''
+
+import os
+import re
+import logging
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+TLD_FILE = os.path.join(DATA_DIR, 'tlds.txt')
+ABUSED_TLD_FILE = os.path.join(DATA_DIR, 'abused_tlds.txt')
+
+TOKEN_SPLIT = re.compile(r'[\s,;()<>\[\]{}"\'«»]+').split
+HOST_END = re.compile(r'[/?#:]').split
+WWW = re.compile(r'^w+$', re.IGNORECASE).match
+STRIP = '.,:;!?¡¿*_~|'
+
+
+def get_tlds(path):
+    '''Last label of each rule of a public suffix list (or one TLD per line).'''
+    tlds = set()
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            line = line.split('//', 1)[0].strip()
+            if not line:
+                continue
+            tld = line.rsplit('.', 1)[-1].lstrip('!*').lower()
+            if tld:
+                tlds.add(tld)
+                try:
+                    tlds.add(tld.encode('idna').decode('ascii'))
+                except UnicodeError:
+                    pass
+    return frozenset(tlds)
+
+
+class UrlDetector:
+
+    '''Search URLs and e-mails in a text.
+
+    The text is split into tokens once and the last label of each host
+    candidate is looked up in the set of top-level domains, if it is
+    followed by a path (or query, port), or else in the TLDs of the spam.
+    With a prefix (scheme, `@` or `www.`) any host with two or more labels
+    is enough.
+    '''
+
+    __slots__ = ('logger', 'path', 'abused_path', 'tlds')
+
+    def __init__(self, path=TLD_FILE, abused_path=ABUSED_TLD_FILE):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.abused_path = abused_path
+        self.tlds = (frozenset(), frozenset())  # (all, abused)
+        self.load()
+
+    def __repr__(self):
+        return f'«{self.__class__.__name__}:{len(self.tlds[0])}:{len(self.tlds[1])}»'
+
+    def load(self):
+        '''(Re)load the TLDs, on error the previous ones are kept.'''
+        try:
+            tlds = (get_tlds(self.path), get_tlds(self.abused_path))
+        except (OSError, ValueError) as error:
+            self.logger.error('TLDs not loaded: %s', error)
+            return False
+        self.tlds = tlds  # both at once
+        self.logger.info('TLDs loaded: %d, abused: %d', *map(len, tlds))
+        return True
+
+    def __call__(self, text):
+        tlds, abused = self.tlds
+        for token in TOKEN_SPLIT(text):
+            if '.' not in token:
+                continue
+
+            prefix = False
+            if '://' in token:
+                token = token.split('://', 1)[1]
+                prefix = True
+            if '@' in token:
+                token = token.rsplit('@', 1)[1]
+                prefix = True
+
+            parts = HOST_END(token, 1)
+            labels = parts[0].strip(STRIP).split('.')
+            if len(labels) < 2 or not all(labels):
+                continue
+            tld = labels[-1].lower()
+            if prefix or tld in abused:
+                return True
+            if len(parts) > 1 and parts[1].strip(STRIP) and tld in tlds:
+                return True
+            if len(labels) > 2 and WWW(labels[0]):
+                return True
+        return False
@@ -0,0 +1,178 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2019 Schmidt Cristian Hernán
+'''Webhook that acknowledges the updates as soon as they are queued.
+
+Each update is validated and put in a bounded queue drained by the
+dispatcher, the handlers never run in the request. When the queue is full
+the answer is 429 and Telegram delivers the update again later, so the
+latency does not build up behind the global lock of the handlers.
+'''
+
+import json
+import time
+import signal
+import logging
+import threading
+import http.server
+
+from queue import Full
+
+MAX_BODY = 1 << 20  # bytes
+RETRY_AFTER = 5  # seconds
+DRAIN_INTERVAL = 0.1  # seconds
+
+logger = logging.getLogger(__name__)
+
+
+class Ingestion:
+    # pylint: disable=too-many-instance-attributes
+
+    '''Bounded entry of the updates into one or more queues.
+
+    `route(data)` chooses the index of the queue and `convert(data, raw)`
+    builds the item queued. The updates already in `seen` are acknowledged
+    and dropped before any other work, and forgotten again if they are not
+    queued. The limit is checked against `qsize`, so with many requests at
+    the same time an unbounded queue can exceed it by a few items; a bounded
+    one is never waited for, full is answered as saturated.
+    '''
+
+    __slots__ = ('queues', 'limit', 'route', 'convert', 'seen', 'lock',
+                 'accepted', 'rejected', 'saturated')
+
+    def __init__(self, queues, limit, route=None, convert=None, seen=None):
+        # pylint: disable=too-many-arguments
+        self.queues = tuple(queues)
+        self.limit = limit
+        self.route = route
+        self.convert = convert
+        self.seen = seen
+        self.lock = threading.Lock()
+        self.accepted = 0
+        self.rejected = 0
+        self.saturated = False
+
+    def __repr__(self):
+        return f'«{self.__class__.__name__}:{self.depths()}/{self.limit}»'
+
+    def depths(self):
+        return [queue.qsize() for queue in self.queues]
+
+    def to_dict(self):
+        result = {'depths': self.depths(), 'limit': self.limit,
+                  'accepted': self.accepted, 'rejected': self.rejected}
+        if self.seen:
+            result['seen'] = self.seen.to_dict()
+        return result
+
+    def offer(self, raw):
+        '''Queue the update, False if saturated. ValueError if invalid.'''
+        data = json.loads(raw)
+        update_id = data.get('update_id') if isinstance(data, dict) else None
+        if not isinstance(update_id, int):
+            raise ValueError('not an update')
+        queue = self.queues[self.route(data) if self.route else 0]
+        if self.seen and not self.seen.add(update_id):
+            return True
+
+        try:
+            if queue.qsize() >= self.limit:
+                raise Full
+            queue.put_nowait(self.convert(data, raw) if self.convert else raw)
+        except Full:
+            self.forget(update_id)
+            with self.lock:
+                self.rejected += 1
+                if not self.saturated:
+                    self.saturated = True
+                    logger.warning('webhook saturated: %s', self.to_dict())
+            return False
+        except:
+            self.forget(update_id)  # it can be delivered again
+            raise
+
+        with self.lock:
+            self.accepted += 1
+            if self.saturated:
+                self.saturated = False
+                logger.warning('webhook recovered: %s', self.to_dict())
+        return True
+
+    def forget(self, update_id):
+        if self.seen:
+            self.seen.discard(update_id)
+
+
+def get_request_handler(url_path, ingestion):
+
+    class RequestHandler(http.server.BaseHTTPRequestHandler):
+
+        def do_POST(self):  # pylint: disable=invalid-name
+            if self.path.strip('/') != url_path:
+                self.send_error(403)
+                return
+            length = int(self.headers.get('Content-Length') or 0)
+            if length > MAX_BODY:
+                self.send_error(413)
+                return
+            try:
+                accepted = ingestion.offer(self.rfile.read(length))
+            except (ValueError, KeyError, TypeError):
+                self.send_error(400)
+                return
+            if accepted:
+                self.send_response(200)
+            else:
+                self.send_response(429)
+                self.send_header('Retry-After', str(RETRY_AFTER))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            # Depth of the queues, only in the secret path
+            if self.path.strip('/') != url_path:
+                self.send_error(403)
+                return
+            body = json.dumps(ingestion.to_dict()).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            logger.debug(*args)
+
+    return RequestHandler
+
+
+def serve(ingestion, url_path, bind, port):
+    '''Serve the webhook until it is interrupted (SIGINT or SIGTERM).'''
+    handler = get_request_handler(url_path, ingestion)
+    server = http.server.ThreadingHTTPServer((bind, port), handler)
+    signal.signal(signal.SIGTERM,
+                  lambda *_: threading.Thread(target=server.shutdown).start())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def start_dispatcher(updater, name='dispatcher'):
+    '''Start the jobs and the dispatcher of the updater, without its server.'''
+    updater.job_queue.start()
+    thread = threading.Thread(target=updater.dispatcher.start, name=name)
+    thread.start()
+    return thread
+
+
+def stop_dispatcher(updater, thread):
+    '''Stop after processing the updates already acknowledged.'''
+    # The jobs last, the handlers of the queued updates can add more
+    while updater.dispatcher.update_queue.qsize():
+        time.sleep(DRAIN_INTERVAL)
+    updater.dispatcher.stop()
+    updater.job_queue.stop()
+    thread.join()
@@ -0,0 +1,146 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2019 Schmidt Cristian Hernán
+'''Write-behind of routine changes of columns.'''
+
+import logging
+import threading
+import collections
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm.attributes import set_committed_value
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehind:
+
+    '''Changes of columns kept in memory and written in grouped commits.
+
+    `set` changes the object without making it dirty and records the value,
+    which is applied again to the object each time that the row is loaded,
+    so the reads always see the last value. `increment` records a relative
+    change instead, so the counters of several processes add up. `flush`
+    writes all of them with an UPDATE by model and values. A normal
+    assignment of a column drops its pending change. Without delay the
+    changes are normal assignments.
+    '''
+
+    __slots__ = ('lock', 'delay', 'pending', 'deltas')
+
+    def __init__(self, base, attributes, delay):
+        self.lock = threading.Lock()
+        self.delay = delay  # seconds between flushes, 0: write-through
+        self.pending = {}  # (model, identity): {name: value}
+        self.deltas = {}  # (model, identity): {name: increment}
+        if delay:
+            event.listen(base, 'load', self.on_load, propagate=True)
+            event.listen(base, 'refresh', self.on_refresh, propagate=True)
+            for attribute in attributes:
+                event.listen(attribute, 'set', self.on_set)
+
+    def __repr__(self):
+        return f'«{self.__class__.__name__}:{len(self.pending)}»'
+
+    def __len__(self):
+        return len(self.pending.keys() | self.deltas.keys())
+
+    def set(self, obj, name, value):
+        identity = inspect(obj).identity
+        if not self.delay or identity is None:
+            setattr(obj, name, value)
+            return
+        set_committed_value(obj, name, value)
+        key = (type(obj), identity)
+        with self.lock:
+            self.pending.setdefault(key, {})[name] = value
+            self.deltas.get(key, {}).pop(name, None)
+
+    def increment(self, obj, name, amount=1):
+        identity = inspect(obj).identity
+        value = getattr(obj, name) + amount
+        if not self.delay or identity is None:
+            setattr(obj, name, value)
+            return
+        set_committed_value(obj, name, value)
+        key = (type(obj), identity)
+        with self.lock:
+            values = self.pending.get(key)
+            if values and name in values:
+                values[name] = value  # after a set it is still absolute
+            else:
+                deltas = self.deltas.setdefault(key, {})
+                deltas[name] = deltas.get(name, 0) + amount
+
+    def on_load(self, obj, context, attrs=None):
+        # pylint: disable=unused-argument
+        key = (type(obj), inspect(obj).identity)
+        values = self.pending.get(key)
+        if values:
+            for name, value in tuple(values.items()):
+                set_committed_value(obj, name, value)
+        deltas = self.deltas.get(key)
+        if deltas:
+            # Only to the values just read, the others already have it
+            for name, amount in tuple(deltas.items()):
+                if attrs is None or name in attrs:
+                    set_committed_value(obj, name, getattr(obj, name) + amount)
+
+    def on_refresh(self, obj, context, attrs):
+        self.on_load(obj, context, attrs)
+
+    def on_set(self, obj, value, oldvalue, initiator):
+        # pylint: disable=unused-argument
+        key = (type(obj), inspect(obj).identity)
+        with self.lock:
+            for changes in (self.pending.get(key), self.deltas.get(key)):
+                if changes:
+                    changes.pop(initiator.key, None)
+
+    def flush(self, dbs):
+        '''Write and commit the pending changes, return the number of rows.'''
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            deltas, self.deltas = self.deltas, {}
+
+        groups = get_groups(pending, deltas)
+        if not groups:
+            return 0
+
+        try:
+            for (model, values, relative), ids in groups.items():
+                if relative:
+                    values = tuple((name, getattr(model, name) + amount)
+                                   for name, amount in values)
+                dbs.query(model).filter(model.id.in_(ids)).update(
+                    dict(values), synchronize_session=False)
+            dbs.commit()
+        except:
+            self.restore(pending, deltas)
+            raise
+        rows = sum(map(len, groups.values()))
+        logger.debug('write-behind: %d rows in %d updates', rows, len(groups))
+        return rows
+
+    def restore(self, pending, deltas):
+        # The values set meanwhile are newer, the increments add up
+        with self.lock:
+            for key, values in pending.items():
+                current = self.pending.setdefault(key, {})
+                for name, value in values.items():
+                    current.setdefault(name, value)
+            for key, values in deltas.items():
+                current = self.deltas.setdefault(key, {})
+                newer = self.pending.get(key, {})
+                for name, amount in values.items():
+                    if name not in newer:
+                        current[name] = current.get(name, 0) + amount
+
+
+def get_groups(pending, deltas):
+    '''{(model, values, relative): [id]}, the rows with the same changes.'''
+    groups = collections.defaultdict(list)
+    for relative, changes in ((False, pending), (True, deltas)):
+        for (model, identity), values in changes.items():
+            if values:
+                groups[model, tuple(sorted(values.items())), relative].append(identity[0])
+    return groups